@@ -0,0 +1,397 @@
+# Offline benchmark of the download engines against a local stand-in for the CDN
+# python -m benchmarks.download --profile tiny --latency 20 --error-rate 0.01
+import os
+import re
+import sys
+import math
+import lzma
+import random
+import shutil
+import struct
+import hashlib
+import logging
+import argparse
+import tempfile
+import threading
+import multiprocessing
+import urllib.parse
+import requests
+from time import monotonic, perf_counter, sleep
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ProcessPoolExecutor
+from nile import constants
+from nile.api.session import APIHandler
+from nile.arguments import max_workers_type, speed_type
+from nile.downloading.bandwidth import TokenBucket
+from nile.downloading.manager import DownloadManager
+from nile.models.manifest import Manifest, RSA, PKCS1_v1_5, SHA256
+from nile.proto import sds_proto2_pb2 as sds
+from nile.utils.config import Config
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+KiB = 1024
+MiB = 1024 * KiB
+
+
+def tiny_files(rng, total):
+    sizes = []
+    while total > 0:
+        sizes.append(min(rng.randint(1 * KiB, 64 * KiB), total))
+        total -= sizes[-1]
+    return sizes
+
+
+def mixed_files(rng, total):
+    sizes = []
+    while total > 0:
+        size = int(rng.lognormvariate(math.log(256 * KiB), 2))
+        sizes.append(max(min(size, total), 1))
+        total -= sizes[-1]
+    return sizes
+
+
+def huge_files(rng, total):
+    """Two files, with --size over 512 MiB they are big enough to be downloaded in segments"""
+    return [total // 2, total - total // 2]
+
+
+# Name -> function returning file sizes adding up to the total
+PROFILES = {
+    "tiny": tiny_files,
+    "mixed": mixed_files,
+    "huge": huge_files,
+}
+
+
+def generate_files(directory, sizes):
+    """Writes random files named by their hash, returns manifest entries (path, size, hash)"""
+    blobs = os.path.join(directory, "files")
+    os.makedirs(blobs, exist_ok=True)
+    temp_path = os.path.join(blobs, "generating")
+    files = []
+    for i, size in enumerate(sizes):
+        hasher = hashlib.sha256()
+        with open(temp_path, "wb") as f:
+            remaining = size
+            while remaining:
+                data = os.urandom(min(remaining, MiB))
+                f.write(data)
+                hasher.update(data)
+                remaining -= len(data)
+        digest = hasher.hexdigest()
+        os.replace(temp_path, os.path.join(blobs, digest))
+        files.append((f"data\\{i % 16:02d}\\{i:06d}.bin", size, digest))
+    return files
+
+
+def build_manifest(files, key) -> bytes:
+    """Same format as manifest.proto on the CDN, signed with key instead of Amazon's"""
+    manifest_pb = sds.Manifest()
+    package = manifest_pb.packages.add()
+    package.name = "benchmark"
+    for path, size, digest in files:
+        f = package.files.add()
+        f.path = path
+        f.size = size
+        f.hash.algorithm = sds.sha256
+        f.hash.value = bytes.fromhex(digest)
+    raw_manifest = manifest_pb.SerializeToString()
+
+    header = sds.ManifestHeader()
+    header.compression.algorithm = sds.lzma
+    header.hash.algorithm = sds.sha256
+    header.hash.value = hashlib.sha256(raw_manifest).digest()
+    header.signature.algorithm = sds.sha256_with_rsa
+    header.signature.value = PKCS1_v1_5.new(key).sign(SHA256.new(raw_manifest))
+    header_raw = header.SerializeToString()
+    return struct.pack(">I", len(header_raw)) + header_raw + lzma.compress(raw_manifest)
+
+
+class CDNHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    chunk_size = 64 * KiB
+    # Headers and body are separate writes, Nagle would hold small bodies back
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        started = monotonic()
+        if server.latency:
+            sleep(server.latency)
+
+        relative = os.path.normpath(urllib.parse.urlparse(self.path).path.lstrip("/"))
+        path = os.path.join(server.directory, relative)
+        if relative.startswith("..") or not os.path.isfile(path):
+            return self.send_empty(404)
+        # Manifest has to arrive, installer doesn't retry it
+        failure = "files" in relative.split(os.sep) and server.rng.random() < server.error_rate
+        if failure and server.rng.random() < 0.5:
+            server.count_error()
+            return self.send_empty(503)
+
+        size = os.path.getsize(path)
+        start, end = 0, size
+        status = 200
+        match = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        if match:
+            start = int(match.group(1))
+            end = int(match.group(2)) + 1 if match.group(2) else size
+            status = 206
+        self.send_response(status)
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {start}-{end - 1}/{size}")
+        if server.content_length:
+            self.send_header("Content-Length", str(end - start))
+        else:
+            # Body ends when the connection does
+            self.send_header("Connection", "close")
+            self.close_connection = True
+        self.end_headers()
+        ttfb = monotonic() - started
+
+        # Other failures drop the connection halfway through the body
+        stop = start + (end - start) // 2 if failure else end
+        connection_bucket = TokenBucket(server.connection_rate)
+        with open(path, "rb") as f:
+            f.seek(start)
+            position = start
+            while position < stop:
+                data = f.read(min(self.chunk_size, stop - position))
+                delay = max(server.bucket.reserve(len(data)), connection_bucket.reserve(len(data)))
+                if delay > 0:
+                    sleep(delay)
+                try:
+                    self.wfile.write(data)
+                except OSError:
+                    # Client gave up
+                    break
+                position += len(data)
+        if failure:
+            self.close_connection = True
+            server.count_error()
+        server.record(ttfb, monotonic() - started)
+
+    def send_empty(self, status):
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+class CDNServer(ThreadingHTTPServer):
+    """
+    Serves directory the way the CDN serves a game, <game>/manifest.proto and <game>/files/<hash>
+    Latency is added before every response, rates are in bytes per second, 0 means unlimited
+    """
+
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, directory, latency=0, rate=0, connection_rate=0, error_rate=0, content_length=True, seed=0):
+        super().__init__(("127.0.0.1", 0), CDNHandler)
+        self.directory = directory
+        self.latency = latency
+        self.bucket = TokenBucket(rate)
+        self.connection_rate = connection_rate
+        self.error_rate = error_rate
+        self.content_length = content_length
+        self.rng = random.Random(seed)
+
+        self.lock = threading.Lock()
+        self.ttfb = []
+        self.durations = []
+        self.errors = 0
+
+    def record(self, ttfb, duration):
+        with self.lock:
+            self.ttfb.append(ttfb)
+            self.durations.append(duration)
+
+    def count_error(self):
+        with self.lock:
+            self.errors += 1
+
+    def collect(self) -> dict:
+        """Returns statistics of requests since last call"""
+        with self.lock:
+            stats = dict(ttfb=self.ttfb, durations=self.durations, errors=self.errors)
+            self.ttfb = []
+            self.durations = []
+            self.errors = 0
+        return stats
+
+
+def serve(directory, options, connection):
+    """Runs CDNServer, answers "collect" with statistics until "stop" arrives"""
+    server = CDNServer(directory, **options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    connection.send(server.server_address[1])
+    while connection.recv() != "stop":
+        connection.send(server.collect())
+    server.shutdown()
+
+
+class LocalLibrary:
+    """Answers library calls DownloadManager makes while installing"""
+
+    def __init__(self, url):
+        self.url = url
+
+    def get_game_manifest(self, id):
+        return dict(versionId="benchmark", downloadUrl=self.url)
+
+    def get_installed_game_info(self, id):
+        return dict()
+
+    def get_patches(self, *args):
+        return []
+
+
+class LocalSession(APIHandler):
+    def set_pool_size(self, size):
+        super().set_pool_size(size)
+        # Keep as many connections to the local server as to the CDN
+        self.session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=size))
+
+
+def get_peak_rss():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes everywhere but macOS
+    return peak if sys.platform == "darwin" else peak * KiB
+
+
+def install(url, public_key, install_path, config_path, engine, max_workers, verbose=False) -> dict:
+    """Installs the benchmark game, runs in its own process so peak RSS belongs to this run only"""
+    logging.basicConfig(level=logging.DEBUG if verbose else logging.WARNING)
+    constants.CONFIG_PATH = config_path
+    Manifest._amz_rsa_key = RSA.import_key(public_key)
+    config = Config()
+    session = LocalSession(config)
+    ttfb = []
+
+    def record_ttfb(response, *args, **kwargs):
+        # Thread engine only, elapsed ends once headers are parsed
+        if "/files/" in response.url:
+            ttfb.append(response.elapsed.total_seconds())
+
+    session.session.hooks["response"].append(record_ttfb)
+    game = dict(id="benchmark", product=dict(id="benchmark", title="Benchmark"))
+    manager = DownloadManager(config, LocalLibrary(url), session, game)
+    started = perf_counter()
+    success = manager.download(install_path=install_path, engine=engine, max_workers=max_workers)
+    return dict(
+        success=success,
+        elapsed=perf_counter() - started,
+        ttfb=ttfb,
+        errors=sum(manager.results.errors.values()),
+        retries=manager.results.retries,
+        peak_rss=get_peak_rss(),
+    )
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def format_times(values, fractions=(0.5, 0.95, 0.99)) -> str:
+    if not values:
+        return "n/a"
+    return " ".join(
+        f"p{fraction * 100:g} {percentile(values, fraction) * 1000:.1f}ms" for fraction in fractions
+    )
+
+
+def report(name, sizes, result, stats):
+    total = sum(sizes)
+    peak_rss = result["peak_rss"]
+    print(f"{name}: {total / MiB:.1f} MiB in {len(sizes)} files, {'ok' if result['success'] else 'FAILED'}")
+    print(f"  time {result['elapsed']:.2f}s, {total / result['elapsed'] / 1000 / 1000:.1f} MB/s")
+    print(f"  client TTFB {format_times(result['ttfb'])}")
+    print(f"  server TTFB {format_times(stats['ttfb'])}")
+    print(f"  request time {format_times(stats['durations'], (0.5, 0.95, 0.99, 0.999))}")
+    print(
+        f"  injected errors {stats['errors']}, errors seen {result['errors']}, retries {result['retries']}, "
+        f"peak RSS {f'{peak_rss / MiB:.1f} MiB' if peak_rss else 'n/a'}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark download engines against a local CDN stand-in")
+    parser.add_argument("--profile", choices=PROFILES.keys(), action="append", help="File size distribution, all by default")
+    parser.add_argument("--engine", choices=["threads", "async"], action="append", help="Download engine, threads by default")
+    parser.add_argument("--max-workers", type=max_workers_type, help="Passed to the download manager")
+    parser.add_argument("--size", type=int, default=512, help="Total size of a game in MiB")
+    parser.add_argument("--latency", type=float, default=0, help="Milliseconds before every response")
+    parser.add_argument("--bandwidth", type=speed_type, default=0, help="Server bandwidth, e.g. 100M")
+    parser.add_argument("--connection-bandwidth", type=speed_type, default=0, help="Bandwidth of a single connection")
+    parser.add_argument("--error-rate", type=float, default=0, help="Fraction of file requests that fail, half with 503, half cut in the middle")
+    parser.add_argument("--no-content-length", action="store_true", help="Send responses without Content-Length")
+    parser.add_argument("--directory", help="Where to put generated and downloaded files, system temporary directory by default")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--verbose", action="store_true", help="Show logs of the download manager")
+    args = parser.parse_args()
+
+    # Same start method on every platform, so numbers are comparable
+    context = multiprocessing.get_context("spawn")
+    key = RSA.generate(2048)
+    public_key = key.publickey().export_key()
+    rng = random.Random(args.seed)
+    options = dict(
+        latency=args.latency / 1000,
+        rate=args.bandwidth,
+        connection_rate=args.connection_bandwidth,
+        error_rate=args.error_rate,
+        content_length=not args.no_content_length,
+        seed=args.seed,
+    )
+
+    with tempfile.TemporaryDirectory(dir=args.directory) as directory:
+        served = os.path.join(directory, "cdn")
+        os.makedirs(served)
+        connection, server_connection = context.Pipe()
+        server = context.Process(target=serve, args=(served, options, server_connection), daemon=True)
+        server.start()
+        port = connection.recv()
+
+        failed = False
+        for profile in args.profile or PROFILES:
+            sizes = PROFILES[profile](rng, args.size * MiB)
+            game_path = os.path.join(served, profile)
+            files = generate_files(game_path, sizes)
+            with open(os.path.join(game_path, "manifest.proto"), "wb") as f:
+                f.write(build_manifest(files, key))
+
+            for engine in args.engine or ["threads"]:
+                install_path = os.path.join(directory, "install")
+                config_path = os.path.join(directory, "config")
+                with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                    result = executor.submit(
+                        install, f"http://127.0.0.1:{port}/{profile}", public_key,
+                        install_path, config_path, engine, args.max_workers, args.verbose
+                    ).result()
+                connection.send("collect")
+                report(f"{profile}/{engine}", sizes, result, connection.recv())
+                failed = failed or not result["success"]
+                shutil.rmtree(install_path, ignore_errors=True)
+                shutil.rmtree(config_path, ignore_errors=True)
+            shutil.rmtree(game_path)
+
+        connection.send("stop")
+        server.join()
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
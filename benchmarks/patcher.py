@@ -0,0 +1,185 @@
+# Measures Patcher throughput on synthetic FUEL_PATCH streams
+# python -m benchmarks.patcher --size 64 --mix merge --compression zstd
+import os
+import sys
+import random
+import hashlib
+import tempfile
+import argparse
+import zstandard as zstd
+from time import perf_counter
+from nile.models.patcher import Patcher, Instructions, PatchCompression
+
+# Relative weights of Seek, Copy, Insert, Merge
+MIXES = {
+    "copy": (0, 1, 0, 0),
+    "insert": (0, 0, 1, 0),
+    "merge": (0, 0, 0, 1),
+    "seek-copy": (1, 2, 0, 0),
+    "mixed": (1, 4, 2, 3),
+}
+
+# (min, max) length of a single instruction
+LENGTHS = {
+    "small": (1, 256),
+    "large": (64 * 1024, 4 * 1024 * 1024),
+}
+
+COMPRESSIONS = {
+    "none": PatchCompression.NONE,
+    "zstd": PatchCompression.ZSTD,
+}
+
+
+def encode_instruction(instruction: Instructions, length) -> bytes:
+    """Inverse of PatchReader.read_instruction"""
+    if instruction == Instructions.Seek:
+        bitmask = 31
+        flags = 32 if length < 0 else 0
+        length = abs(length)
+    else:
+        bitmask = 63
+        flags = 0
+    value = length - 1
+    head = instruction.value << 6 | flags
+    if value < bitmask - 4:
+        return bytes([head | value])
+    byte_count = max((value.bit_length() + 7) // 8, 1)
+    return bytes([head | (bitmask - 5 + byte_count)]) + value.to_bytes(byte_count, byteorder='big')
+
+
+class SyntheticPatch:
+    """Builds a patch instruction by instruction together with the target it produces"""
+
+    def __init__(self, source: bytes, rng: random.Random):
+        self.source = source
+        self.rng = rng
+        self.position = 0
+        self.body = []
+        self.target = []
+        self.target_size = 0
+        self.instructions = 0
+
+    def add(self, instruction, length, data=b""):
+        self.body.append(encode_instruction(instruction, length))
+        self.body.append(data)
+        self.instructions += 1
+
+    def seek(self, offset):
+        self.add(Instructions.Seek, offset)
+        self.position += offset
+
+    def copy(self, length):
+        self.add(Instructions.Copy, length)
+        self.emit(self.source[self.position:self.position + length])
+        self.position += length
+
+    def insert(self, length):
+        data = os.urandom(length)
+        self.add(Instructions.Insert, length, data)
+        self.emit(data)
+
+    def merge(self, length):
+        """Sparse changes, like a recompiled binary"""
+        delta = bytearray(length)
+        result = bytearray(self.source[self.position:self.position + length])
+        for i in self.rng.sample(range(length), max(length // 64, 1)):
+            delta[i] = self.rng.randrange(1, 256)
+            result[i] = (result[i] + delta[i]) & 255
+        self.add(Instructions.Merge, length, bytes(delta))
+        self.emit(bytes(result))
+        self.position += length
+
+    def emit(self, data):
+        self.target.append(data)
+        self.target_size += len(data)
+
+    def encode(self, compression: PatchCompression) -> bytes:
+        body = b"".join(self.body)
+        if compression == PatchCompression.ZSTD:
+            body = zstd.ZstdCompressor().compress(body)
+        return bytes([compression.value]) + body
+
+
+def generate(size, mix, lengths, seed=0) -> SyntheticPatch:
+    """Generates a source of size bytes and a patch producing target of about the same size"""
+    rng = random.Random(seed)
+    source = os.urandom(size)
+    patch = SyntheticPatch(source, rng)
+    low, high = LENGTHS[lengths]
+    instructions = list(Instructions)
+    weights = MIXES[mix]
+    while patch.target_size < size:
+        instruction = rng.choices(instructions, weights)[0]
+        length = min(rng.randint(low, high), size - patch.target_size)
+        if instruction == Instructions.Seek:
+            offset = rng.randint(-patch.position, size - patch.position - 1)
+            if offset:
+                patch.seek(offset)
+            continue
+        if instruction == Instructions.Insert:
+            patch.insert(length)
+            continue
+        # Copy and Merge need source data left
+        if patch.position >= size:
+            patch.seek(-rng.randint(1, size))
+        length = min(length, size - patch.position)
+        if instruction == Instructions.Copy:
+            patch.copy(length)
+        else:
+            patch.merge(length)
+    return patch
+
+
+def run(size, mix, lengths, compression, repeat=1, seed=0):
+    """Returns (MB/s, instructions/s, whether output matched) of the best run"""
+    patch = generate(size, mix, lengths, seed)
+    expected = hashlib.sha256(b"".join(patch.target)).hexdigest()
+    with tempfile.TemporaryDirectory() as directory:
+        source_path = os.path.join(directory, "source")
+        patch_path = os.path.join(directory, "patch")
+        target_path = os.path.join(directory, "target")
+        with open(source_path, "wb") as f:
+            f.write(patch.source)
+        with open(patch_path, "wb") as f:
+            f.write(patch.encode(COMPRESSIONS[compression]))
+
+        best = None
+        valid = True
+        for _ in range(repeat):
+            started = perf_counter()
+            Patcher(open(source_path, "rb"), open(patch_path, "rb"), open(target_path, "wb")).run()
+            elapsed = perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+            with open(target_path, "rb") as f:
+                valid = valid and hashlib.sha256(f.read()).hexdigest() == expected
+    return patch.target_size / best / 1000 / 1000, patch.instructions / best, valid
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark FUEL_PATCH patcher")
+    parser.add_argument("--size", type=int, default=32, help="Target size in MiB")
+    parser.add_argument("--mix", choices=MIXES.keys(), action="append", help="Instruction mix, all by default")
+    parser.add_argument("--lengths", choices=LENGTHS.keys(), action="append", help="Instruction lengths, all by default")
+    parser.add_argument("--compression", choices=COMPRESSIONS.keys(), action="append", help="Patch compression, all by default")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs of every case, the best one is reported")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    size = args.size * 1024 * 1024
+    failed = False
+    print(f"{'mix':<10} {'lengths':<8} {'compression':<12} {'MB/s':>10} {'instr/s':>12}  output")
+    for mix in args.mix or MIXES:
+        for lengths in args.lengths or LENGTHS:
+            for compression in args.compression or COMPRESSIONS:
+                speed, rate, valid = run(size, mix, lengths, compression, args.repeat, args.seed)
+                failed = failed or not valid
+                print(
+                    f"{mix:<10} {lengths:<8} {compression:<12} {speed:>10.1f} {rate:>12.0f}  "
+                    f"{'ok' if valid else 'MISMATCH'}"
+                )
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
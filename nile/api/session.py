@@ -5,8 +5,11 @@ class APIHandler():
     def __init__(self, config_manager):
         self.config = config_manager
         self.session = requests.Session()
-        adapter = requests.adapters.HTTPAdapter(pool_maxsize=12)
-        self.session.mount("https://", adapter)
+        self.set_pool_size(12)
         self.session.headers.update({
             'User-Agent': 'AGSLauncher/1.0.0'
         })
+
+    def set_pool_size(self, size):
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=size)
+        self.session.mount("https://", adapter)
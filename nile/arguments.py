@@ -1,5 +1,38 @@
 from os import path
 
+def max_workers_type(value):
+    import argparse
+
+    if value == "auto":
+        return value
+    try:
+        workers = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected a number or auto")
+    if workers < 1:
+        raise argparse.ArgumentTypeError("expected at least 1 worker")
+    return workers
+
+def speed_type(value):
+    import argparse
+    from nile.utils.download import parse_speed
+
+    try:
+        return parse_speed(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected speed like 500K, 10M or 0 for unlimited")
+
+def fd_type(value):
+    import argparse
+
+    try:
+        fd = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected a file descriptor number")
+    if fd < 0:
+        raise argparse.ArgumentTypeError("expected a file descriptor number")
+    return fd
+
 def get_arguments():
     import argparse
 
@@ -45,7 +78,30 @@ def get_arguments():
         
     )
     install_parser.add_argument("id", help="Specify a ID of the game to be installed")
-    install_parser.add_argument("--max-workers", help="Specify max threads to be used")
+    install_parser.add_argument(
+        "--max-workers",
+        type=max_workers_type,
+        help="Specify max concurrent downloads to be used, auto tunes it based on measured throughput",
+    )
+    install_parser.add_argument(
+        "--max-speed",
+        type=speed_type,
+        help="Limit download speed in bytes per second, accepts K, M and G suffixes. "
+        "Defaults to max_speed in settings.json. Can be changed while downloading "
+        "by writing a new value to .nile_max_speed in the install directory",
+    )
+    install_parser.add_argument(
+        "--progress-json",
+        type=fd_type,
+        metavar="FD",
+        help="Write progress as JSON lines to this file descriptor, e.g. 3 when run with 3>progress.ndjson",
+    )
+    install_parser.add_argument(
+        "--engine",
+        choices=["threads", "async"],
+        default="threads",
+        help="Download engine to use, async requires aiohttp",
+    )
     install_parser.add_argument(
         "--base-path",
         dest="base_path",
@@ -54,6 +110,29 @@ def get_arguments():
     install_parser.add_argument(
         "--path", dest="exact_path", help="Specify exact install location"
     )
+    install_parser.add_argument(
+        "--schedule",
+        choices=["manifest", "largest-first", "smallest-first", "playable-first"],
+        default="manifest",
+        help="Order in which files are downloaded. playable-first gets files needed to launch the game first",
+    )
+    install_parser.add_argument(
+        "--hardlink-duplicates",
+        action="store_true",
+        help="Hardlink files with identical content instead of copying them. Modifying one of them changes all",
+    )
+    install_parser.add_argument(
+        "--blob-cache-size",
+        type=float,
+        default=0,
+        help="Keep up to this many GiB of downloaded files in a cache shared by all games, used for reinstalls",
+    )
+    install_parser.add_argument(
+        "--full",
+        dest="full_verify",
+        action="store_true",
+        help="Hash all files, even the ones unchanged since last verification",
+    )
     install_parser.add_argument(
         '--info', '-i', action="store_true", help="Print game install info instead of downloading" 
     )
@@ -99,5 +178,11 @@ def get_arguments():
     import_parser = sub_parsers.add_parser("import", help="Import games installed outside nile")
     import_parser.add_argument("--path", help="Path to the game's installation folder", type=path.abspath)
     import_parser.add_argument("id", help="The id of the game to import")
+    import_parser.add_argument(
+        "--full",
+        dest="full_verify",
+        action="store_true",
+        help="Hash all files, even the ones unchanged since last verification",
+    )
 
     return parser.parse_known_args(), parser
@@ -3,6 +3,7 @@
 import sys
 import os
 import logging
+import multiprocessing
 import json
 from nile.arguments import get_arguments
 from nile.downloading import manager
@@ -167,11 +168,22 @@ class CLI:
             self.config, self.library_manager, self.session, matching_game
         )
         if not self.arguments.info:
-            self.download_manager.download(
+            success = self.download_manager.download(
                 force_verifying=bool(self.arguments.command == "verify"),
                 base_install_path=self.arguments.base_path,
                 install_path=self.arguments.exact_path,
+                engine=self.arguments.engine,
+                max_workers=self.arguments.max_workers,
+                full_verify=self.arguments.full_verify,
+                hardlink_duplicates=self.arguments.hardlink_duplicates,
+                blob_cache_size=self.arguments.blob_cache_size,
+                schedule=self.arguments.schedule,
+                max_speed=self.arguments.max_speed,
+                progress_json=self.arguments.progress_json,
             )
+            if not success:
+                self.logger.error("Download failed")
+                sys.exit(1)
             self.logger.info("Download complete")
         else:
             self.download_manager.info(self.arguments.json)
@@ -307,7 +319,8 @@ class CLI:
             self.config, self.library_manager, self.session, matching_game
         )
         importer = Importer(
-            matching_game, path, self.config, self.library_manager, self.session, self.download_manager
+            matching_game, path, self.config, self.library_manager, self.session, self.download_manager,
+            full_verify=self.arguments.full_verify
         )
         importer.import_game()
  
@@ -361,4 +374,6 @@ def main():
 
 
 if __name__ == "__main__":
+    # Patches are applied in spawned processes, needed for frozen executables
+    multiprocessing.freeze_support()
     sys.exit(main())
@@ -0,0 +1,292 @@
+import os
+import asyncio
+import logging
+from time import time
+from nile.downloading.worker import DownloadWorker
+from nile.downloading.concurrency import ConcurrencyLimiter
+from nile.downloading.retry import HTTPStatusError, RangeNotSupported
+
+aiohttp_available = True
+
+try:
+    import aiohttp
+except Exception:
+    log = logging.getLogger('aiohttp')
+    log.debug('aiohttp unavailable')
+    aiohttp_available = False
+
+
+class AsyncLimiter:
+    """asyncio gate following the limit of a ConcurrencyLimiter tuned from another thread"""
+
+    def __init__(self, limiter: ConcurrencyLimiter):
+        self.limiter = limiter
+        self.active = 0
+        self.condition = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.active < self.limiter.limit)
+            self.active += 1
+
+    async def __aexit__(self, *args):
+        async with self.condition:
+            self.active -= 1
+            self.condition.notify_all()
+
+
+class AsyncDownloadEngine:
+    """
+    Downloads files on a single asyncio event loop
+    Reuses DownloadWorker for verification, resuming and journaling,
+    only the network part is done with aiohttp
+    """
+
+    def __init__(self, workers, session_manager, results, max_connections=256, limiter=None):
+        self.workers = workers
+        self.results = results
+        self.headers = dict(session_manager.session.headers)
+        self.max_connections = max_connections
+        self.limiter = limiter
+        self.logger = logging.getLogger("ASYNC")
+
+    def run(self):
+        asyncio.run(self._run())
+
+    async def _run(self):
+        if self.limiter:
+            self.semaphore = AsyncLimiter(self.limiter)
+        else:
+            self.semaphore = asyncio.Semaphore(self.max_connections)
+        connector = aiohttp.TCPConnector(limit=self.max_connections)
+        timeout = aiohttp.ClientTimeout(total=None, sock_read=60)
+        async with aiohttp.ClientSession(
+            headers=self.headers, connector=connector, timeout=timeout
+        ) as session:
+            self.session = session
+            # Fixed number of consumers pulls workers lazily from the shared iterator
+            workers = iter(self.workers)
+            await asyncio.gather(
+                *[self.consume(workers) for _ in range(self.max_connections)]
+            )
+
+    async def consume(self, workers):
+        for worker in workers:
+            await self.run_worker(worker)
+
+    async def run_worker(self, worker: DownloadWorker):
+        try:
+            success = await self.execute(worker)
+        except Exception as e:
+            self.results.record_error(worker.data.path, e)
+        else:
+            self.results.record(worker.data.path, success)
+
+    async def execute(self, worker: DownloadWorker) -> bool:
+        loop = asyncio.get_running_loop()
+        file_path = worker.get_path()
+        if (
+            worker.journal and worker.journal.is_completed(worker.data, file_path)
+        ) or await loop.run_in_executor(None, self.check_local, worker, file_path):
+            worker.progress.update_downloaded_size(worker.data.size)
+            # Copies duplicates, keep it off the loop
+            await loop.run_in_executor(None, worker.mark_completed, file_path)
+            return True
+
+        while True:
+            try:
+                return await self.download(worker, file_path)
+            except Exception as e:
+                if worker.is_cancelled():
+                    return False
+                if e is worker.segments_error:
+                    # Segments have used up their own retries, like in the threads engine
+                    raise
+                delay = worker.get_retry_delay(e, worker.attempt)
+                if delay is None:
+                    raise
+                worker.attempt += 1
+                worker.reset_progress()
+                await asyncio.sleep(delay)
+
+    async def download(self, worker: DownloadWorker, path) -> bool:
+        if worker.ranges_supported and worker.data.size > worker.segment_threshold:
+            success = await self.get_segments(worker, path)
+        else:
+            success = await self.get_file(worker, path)
+        if not success:
+            return False
+        if worker.journal:
+            worker.journal.clear_progress(worker.data)
+        return await asyncio.get_running_loop().run_in_executor(None, worker.finalize, path)
+
+    @staticmethod
+    def check_local(worker: DownloadWorker, path) -> bool:
+        return worker.check_existing(path) or worker.fetch_cached(path)
+
+    async def get_file(self, worker: DownloadWorker, path) -> bool:
+        patch_path = path + ".patch"
+        offset = worker.get_resume_offset(patch_path)
+        if offset and offset >= worker.data.size:
+            # Whole file arrived before the last run stopped, the server would answer 416
+            worker.add_progress(offset, received=False)
+            await asyncio.get_running_loop().run_in_executor(
+                None, worker.create_hasher, patch_path, [(0, worker.data.size)], {0: offset}
+            )
+            return True
+        headers = dict()
+        if offset:
+            headers["Range"] = f"bytes={offset}-"
+
+        async with self.semaphore:
+            async with self.request(worker, headers) as response:
+                if offset and response.status != 206:
+                    # Server ignored the range, start over
+                    offset = 0
+                worker.add_progress(offset, received=False)
+                await asyncio.get_running_loop().run_in_executor(
+                    None, worker.create_hasher, patch_path, [(0, worker.data.size)], {0: offset}
+                )
+
+                with worker.open_patch(patch_path) as f:
+                    f.seek(offset)
+                    if not await self.write_response(worker, response, f, 0, offset):
+                        return False
+                    f.truncate()
+                    return True
+
+    async def get_segments(self, worker: DownloadWorker, path) -> bool:
+        patch_path = path + ".patch"
+        progress = dict()
+        if worker.journal and os.path.exists(patch_path) and os.path.getsize(patch_path) == worker.data.size:
+            progress = worker.journal.get_progress(worker.data)
+
+        worker.open_patch(patch_path).close()
+
+        segments = worker.get_segments()
+        written = {start: min(progress.get(start, 0), end - start) for start, end in segments}
+        await asyncio.get_running_loop().run_in_executor(
+            None, worker.create_hasher, patch_path, segments, written
+        )
+        # Let all segments finish before the whole file may be retried
+        results = await asyncio.gather(
+            *[
+                self.get_range_with_retries(worker, patch_path, start, end, written[start])
+                for start, end in segments
+            ],
+            return_exceptions=True,
+        )
+        if not worker.ranges_supported:
+            worker.logger.debug(f"Server ignored ranges of {worker.data.path}, downloading it in one piece")
+            if worker.journal:
+                worker.journal.clear_progress(worker.data)
+            worker.reset_progress()
+            return await self.get_file(worker, path)
+        for result in results:
+            if isinstance(result, Exception):
+                worker.segments_error = result
+                raise result
+        return all(results)
+
+    async def get_range_with_retries(self, worker: DownloadWorker, patch_path, start, end, written) -> bool:
+        worker.add_progress(written, received=False)
+        attempt = 0
+        while True:
+            try:
+                return await self.get_range(worker, patch_path, start, end, written)
+            except RangeNotSupported:
+                worker.ranges_supported = False
+                return True
+            except Exception as e:
+                if worker.is_cancelled():
+                    return False
+                delay = worker.get_retry_delay(e, attempt)
+                if delay is None:
+                    raise
+                attempt += 1
+                await asyncio.sleep(delay)
+                # Continue after the data that already reached the disk
+                written = worker.hasher.get_written(start)
+
+    async def get_range(self, worker: DownloadWorker, patch_path, start, end, written) -> bool:
+        if start + written >= end:
+            return True
+
+        headers = {"Range": f"bytes={start + written}-{end - 1}"}
+        async with self.semaphore:
+            if not worker.ranges_supported:
+                # Another segment got the whole file, this one is downloaded with it
+                return True
+            async with self.request(worker, headers) as response:
+                if response.status != 206:
+                    raise RangeNotSupported()
+
+                with open(patch_path, "r+b") as f:
+                    f.seek(start + written)
+                    return await self.write_response(worker, response, f, start, written)
+
+    def request(self, worker: DownloadWorker, headers):
+        return TimedRequest(self.session.get(worker.download_url, headers=headers), self.limiter)
+
+    async def write_response(self, worker: DownloadWorker, response, f, start, written) -> bool:
+        """Async counterpart of DownloadWorker.write_response"""
+        if response.content_length is None:
+            data = await response.read()
+            await self.throttle(worker, len(data))
+            worker.add_progress(len(data))
+            await self.write_chunk(worker, f, start, written, data)
+            return True
+
+        chunk_size = worker.get_chunk_size(response.content_length)
+        async for data in response.content.iter_chunked(chunk_size):
+            if worker.is_cancelled():
+                return False
+            await self.throttle(worker, len(data))
+            worker.add_progress(len(data))
+            if self.limiter:
+                self.limiter.report_bytes(len(data))
+            written += await self.write_chunk(worker, f, start, written, data)
+        return True
+
+    async def throttle(self, worker: DownloadWorker, amount):
+        if worker.bandwidth:
+            delay = worker.bandwidth.reserve(amount)
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+    async def write_chunk(self, worker: DownloadWorker, f, start, written, data) -> int:
+        # Disk writes, hashing and journal saves must not block other streams
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self.write_data, worker, f, start, written, data
+        )
+
+    @staticmethod
+    def write_data(worker: DownloadWorker, f, start, written, data) -> int:
+        bytes_written = f.write(data)
+        worker.progress.update_bytes_written(bytes_written)
+        worker.update_hash(f, start, data)
+        if worker.journal:
+            worker.journal.set_progress(worker.data, start, written + bytes_written)
+            worker.journal.maybe_save()
+        return bytes_written
+
+
+class TimedRequest:
+    """Wraps aiohttp request context reporting time to response headers to the limiter"""
+
+    def __init__(self, request, limiter):
+        self.request = request
+        self.limiter = limiter
+
+    async def __aenter__(self):
+        started = time()
+        response = await self.request.__aenter__()
+        if self.limiter:
+            self.limiter.report_latency(time() - started)
+        if response.status >= 400:
+            response.release()
+            raise HTTPStatusError(response.status)
+        return response
+
+    async def __aexit__(self, *args):
+        return await self.request.__aexit__(*args)
@@ -0,0 +1,123 @@
+import os
+import logging
+import threading
+from time import monotonic
+from nile.utils.download import parse_speed
+
+
+class TokenBucket:
+    """
+    Shared download rate limit, every chunk received draws tokens from it
+    Callers receive a delay to sleep (or await) instead of blocking here,
+    so the same bucket serves both thread and asyncio engines
+    """
+
+    # Seconds of traffic that can be sent at once after idling
+    burst_time = 0.5
+    # Read granularity while limited, smaller chunks give smoother shaping
+    chunk_time = 0.1
+    min_chunk_size = 16 * 1024
+
+    def __init__(self, rate=0):
+        self.lock = threading.Lock()
+        # bytes per second, 0 means unlimited
+        self.rate = 0
+        self.tokens = 0
+        self.updated = monotonic()
+        self.set_rate(rate)
+
+    @property
+    def capacity(self):
+        return self.rate * self.burst_time
+
+    def refill(self):
+        now = monotonic()
+        if self.rate:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def set_rate(self, rate):
+        with self.lock:
+            self.refill()
+            self.rate = rate
+            self.tokens = min(self.tokens, self.capacity)
+
+    def reserve(self, amount) -> float:
+        """Takes amount tokens, returns how many seconds to wait before using them"""
+        with self.lock:
+            if not self.rate:
+                return 0
+            self.refill()
+            # Going into debt lets callers take chunks bigger than the bucket
+            self.tokens -= amount
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+    def chunk_size(self, default) -> int:
+        rate = self.rate
+        if not rate:
+            return default
+        return max(min(default, int(rate * self.chunk_time)), self.min_chunk_size)
+
+
+class SpeedControl(threading.Thread):
+    """
+    Watches a control file for a new speed limit while downloading
+    Writing e.g. `2M` to it changes the limit, `0` removes it,
+    deleting the file restores the initial limit
+    Only changes made while downloading count, a file left by an earlier run is ignored
+    """
+
+    file_name = ".nile_max_speed"
+    interval = 2  # seconds
+
+    def __init__(self, bucket: TokenBucket, install_path):
+        super().__init__(daemon=True)
+        self.bucket = bucket
+        self.path = os.path.join(install_path, self.file_name)
+        self.default_rate = bucket.rate
+        self.logger = logging.getLogger("BANDWIDTH")
+        self.stopped = threading.Event()
+        self.last_mtime = None
+
+    def run(self):
+        self.last_mtime = self.get_mtime()
+        while not self.stopped.wait(self.interval):
+            self.check()
+
+    def stop(self):
+        self.stopped.set()
+
+    def get_mtime(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def check(self):
+        mtime = self.get_mtime()
+        if mtime is None:
+            if self.last_mtime is not None:
+                self.last_mtime = None
+                self.apply(self.default_rate)
+            return
+        if mtime == self.last_mtime:
+            return
+        self.last_mtime = mtime
+        try:
+            with open(self.path, "r") as f:
+                rate = parse_speed(f.read().strip())
+        except (OSError, ValueError):
+            self.logger.warning(f"Invalid speed limit in {self.path}")
+            return
+        self.apply(rate)
+
+    def apply(self, rate):
+        if rate == self.bucket.rate:
+            return
+        self.bucket.set_rate(rate)
+        if rate:
+            self.logger.info(f"Download speed limited to {rate / 1024 / 1024:.02f} MiB/s")
+        else:
+            self.logger.info("Download speed limit removed")
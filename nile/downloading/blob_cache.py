@@ -0,0 +1,114 @@
+import os
+import logging
+import threading
+from collections import OrderedDict
+from nile.models.manifest import File
+from nile.utils.download import clone_file, calculate_checksum, get_hashing_function
+from nile import constants
+
+
+class BlobCache:
+    """
+    Content addressed store of downloaded files shared by all games
+    Blobs are kept under their SHA-256 and the least recently used
+    ones are evicted once the cache grows over max_size
+    """
+
+    def __init__(self, max_size, path=os.path.join(constants.CONFIG_PATH, "blobs")):
+        self.max_size = max_size
+        self.path = path
+        self.logger = logging.getLogger("BLOBCACHE")
+        self.lock = threading.Lock()
+        # hash -> size, ordered from least recently used
+        self.blobs = OrderedDict()
+        self.total_size = 0
+        self.load()
+
+    def load(self):
+        os.makedirs(self.path, exist_ok=True)
+        entries = []
+        for directory in os.scandir(self.path):
+            if not directory.is_dir():
+                continue
+            for entry in os.scandir(directory.path):
+                if entry.name.endswith(".patch"):
+                    continue
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name, stat.st_size))
+        for _, blob_hash, size in sorted(entries):
+            self.blobs[blob_hash] = size
+            self.total_size += size
+        self.logger.debug(f"Loaded {len(self.blobs)} blobs, {self.total_size} bytes")
+
+    def get_path(self, blob_hash):
+        return os.path.join(self.path, blob_hash[:2], blob_hash)
+
+    @staticmethod
+    def is_cacheable(file: File) -> bool:
+        return file.hash.algorithm.lower() == "sha256"
+
+    def fetch(self, file: File, target) -> bool:
+        """Creates target from cached blob, returns False if there is none or it's corrupted"""
+        if not self.is_cacheable(file):
+            return False
+        with self.lock:
+            if self.blobs.get(file.hash.value) != file.size:
+                return False
+            self.blobs.move_to_end(file.hash.value)
+        blob_path = self.get_path(file.hash.value)
+        try:
+            clone_file(blob_path, target)
+            # mtime keeps the LRU order between runs
+            os.utime(blob_path)
+        except FileNotFoundError:
+            # Evicted by another nile process
+            self.forget(file.hash.value)
+            return False
+        if calculate_checksum(get_hashing_function(file.hash.algorithm), target) != file.hash.value:
+            self.logger.warning(f"Cached blob of {file.path} is corrupted, removing it")
+            os.remove(target)
+            self.remove(file.hash.value)
+            return False
+        self.logger.debug(f"Using cached blob for {file.path}")
+        return True
+
+    def store(self, file: File, path):
+        """Adds verified file to the cache"""
+        if not self.is_cacheable(file) or file.size > self.max_size:
+            return
+        with self.lock:
+            if file.hash.value in self.blobs:
+                self.blobs.move_to_end(file.hash.value)
+                return
+        blob_path = self.get_path(file.hash.value)
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        clone_file(path, blob_path)
+        with self.lock:
+            self.blobs[file.hash.value] = file.size
+            self.total_size += file.size
+        self.evict()
+
+    def forget(self, blob_hash):
+        with self.lock:
+            size = self.blobs.pop(blob_hash, None)
+            if size is not None:
+                self.total_size -= size
+
+    def remove(self, blob_hash):
+        self.forget(blob_hash)
+        try:
+            os.remove(self.get_path(blob_hash))
+        except FileNotFoundError:
+            pass
+
+    def evict(self):
+        while True:
+            with self.lock:
+                if self.total_size <= self.max_size or not self.blobs:
+                    return
+                blob_hash, size = self.blobs.popitem(last=False)
+                self.total_size -= size
+            try:
+                os.remove(self.get_path(blob_hash))
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,126 @@
+import logging
+import threading
+from time import time
+
+
+class ConcurrencyLimiter:
+    """
+    Counting semaphore with adjustable limit
+    Workers hold a slot while transferring data and report how it went,
+    so AdaptiveController can tune the limit
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        self.condition = threading.Condition()
+
+        self.stats_lock = threading.Lock()
+        self.bytes = 0
+        self.latency_total = 0
+        self.latency_count = 0
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+    def acquire(self):
+        with self.condition:
+            while self.active >= self.limit:
+                self.condition.wait()
+            self.active += 1
+
+    def release(self):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify()
+
+    def set_limit(self, limit):
+        with self.condition:
+            self.limit = limit
+            self.condition.notify_all()
+
+    def report_bytes(self, amount):
+        with self.stats_lock:
+            self.bytes += amount
+
+    def report_latency(self, latency):
+        with self.stats_lock:
+            self.latency_total += latency
+            self.latency_count += 1
+
+    def collect(self):
+        """Returns (bytes, average latency) since last call"""
+        with self.stats_lock:
+            amount = self.bytes
+            latency = self.latency_total / self.latency_count if self.latency_count else None
+            self.bytes = self.latency_total = self.latency_count = 0
+        return amount, latency
+
+
+class AdaptiveController(threading.Thread):
+    """
+    AIMD controller for number of concurrent transfers
+    Adds one slot while throughput keeps growing, backs off multiplicatively
+    when throughput drops or request latency spikes
+    """
+
+    interval = 2  # seconds
+    increase_threshold = 1.05
+    decrease_threshold = 0.8
+    latency_threshold = 3
+    backoff_factor = 0.75
+    # Try adding a slot again after this many intervals without changes
+    probe_after = 5
+
+    def __init__(self, limiter: ConcurrencyLimiter, min_limit=2, max_limit=32):
+        super().__init__(daemon=True)
+        self.limiter = limiter
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.logger = logging.getLogger("CONCURRENCY")
+        self.stopped = threading.Event()
+
+        self.last_throughput = None
+        self.base_latency = None
+        self.stable_rounds = 0
+
+    def run(self):
+        last_sample = time()
+        while not self.stopped.wait(self.interval):
+            now = time()
+            amount, latency = self.limiter.collect()
+            self.adjust(amount / (now - last_sample), latency)
+            last_sample = now
+
+    def stop(self):
+        self.stopped.set()
+
+    def adjust(self, throughput, latency):
+        limit = self.limiter.limit
+        if latency is not None:
+            self.base_latency = min(self.base_latency or latency, latency)
+
+        if latency is not None and latency > self.base_latency * self.latency_threshold:
+            new_limit = int(limit * self.backoff_factor)
+        elif self.last_throughput is None or throughput > self.last_throughput * self.increase_threshold:
+            new_limit = limit + 1
+        elif throughput < self.last_throughput * self.decrease_threshold:
+            new_limit = int(limit * self.backoff_factor)
+        elif self.stable_rounds >= self.probe_after:
+            new_limit = limit + 1
+        else:
+            new_limit = limit
+
+        new_limit = max(self.min_limit, min(self.max_limit, new_limit))
+        self.stable_rounds = self.stable_rounds + 1 if new_limit == limit else 0
+        self.last_throughput = throughput
+        if new_limit != limit:
+            self.logger.debug(
+                f"Concurrency {limit} -> {new_limit} "
+                f"({throughput / 1024 / 1024:.02f} MiB/s, latency {latency})"
+            )
+            self.limiter.set_limit(new_limit)
@@ -0,0 +1,118 @@
+import os
+import json
+import logging
+import threading
+from time import time
+from nile.models.manifest import File
+
+
+class DownloadJournal:
+    """
+    Keeps track of completed and partially downloaded files of an install,
+    so interrupted installs and updates can continue where they stopped.
+    Stored as JSON next to the game files and removed once the download finishes
+    """
+
+    filename = ".nile_journal.json"
+    save_interval = 5  # seconds
+
+    def __init__(self, install_path):
+        self.path = os.path.join(install_path, self.filename)
+        self.logger = logging.getLogger("JOURNAL")
+        self.lock = threading.Lock()
+        self.last_save = time()
+        # manifest path -> dict(hash, size, mtime)
+        self.completed = dict()
+        # manifest path -> dict(hash, ranges={range start: bytes written})
+        self.partial = dict()
+        # manifest path -> hash of the file being patched in place
+        self.in_place = dict()
+
+    def load(self):
+        if not os.path.isfile(self.path):
+            return
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            self.logger.warning("Download journal is corrupted, ignoring it")
+            return
+        self.completed = data.get("completed", dict())
+        self.partial = data.get("partial", dict())
+        self.in_place = data.get("in_place", dict())
+        self.logger.info(
+            f"Resuming download, {len(self.completed)} files already completed"
+        )
+
+    def save(self):
+        with self.lock:
+            data = json.dumps(
+                dict(completed=self.completed, partial=self.partial, in_place=self.in_place)
+            )
+            temp_path = self.path + ".tmp"
+            with open(temp_path, "w") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self.path)
+            self.last_save = time()
+
+    def maybe_save(self):
+        if time() - self.last_save >= self.save_interval:
+            self.save()
+
+    def remove(self):
+        with self.lock:
+            self.completed = dict()
+            self.partial = dict()
+            self.in_place = dict()
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+    def is_completed(self, file: File, path) -> bool:
+        entry = self.completed.get(file.path)
+        if not entry or entry["hash"] != file.hash.value:
+            return False
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        return entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime_ns
+
+    def mark_completed(self, file: File, path):
+        stat = os.stat(path)
+        with self.lock:
+            self.partial.pop(file.path, None)
+            self.in_place.pop(file.path, None)
+            self.completed[file.path] = dict(
+                hash=file.hash.value, size=stat.st_size, mtime=stat.st_mtime_ns
+            )
+        self.maybe_save()
+
+    def get_progress(self, file: File) -> dict:
+        """Returns {range start: bytes written} of a partially downloaded file"""
+        entry = self.partial.get(file.path)
+        if not entry or entry["hash"] != file.hash.value:
+            return dict()
+        return {int(start): written for start, written in entry["ranges"].items()}
+
+    def set_progress(self, file: File, start, written):
+        with self.lock:
+            entry = self.partial.get(file.path)
+            if not entry or entry["hash"] != file.hash.value:
+                entry = dict(hash=file.hash.value, ranges=dict())
+                self.partial[file.path] = entry
+            entry["ranges"][str(start)] = written
+
+    def clear_progress(self, file: File):
+        with self.lock:
+            self.partial.pop(file.path, None)
+
+    def mark_in_place(self, file: File):
+        """Saved right away, file can't be trusted once patching it in place begins"""
+        with self.lock:
+            self.in_place[file.path] = file.hash.value
+        self.save()
+
+    def is_in_place(self, file: File) -> bool:
+        return file.path in self.in_place
@@ -1,18 +1,37 @@
 import json
 import logging
 import os
+import shutil
+import threading
 import urllib.parse
 from concurrent.futures import ThreadPoolExecutor
 from multiprocessing import cpu_count
-from time import sleep
 import nile.utils.download as dl_utils
 from nile.models import manifest, hash_pairs, patch_manifest
 from nile.downloading.progress import ProgressBar
 from nile.downloading.worker import DownloadWorker
+from nile.downloading.patch_worker import PatchWorker
+from nile.downloading.patch_pool import PatchPool
+from nile.downloading.journal import DownloadJournal
+from nile.downloading import async_engine
+from nile.downloading.concurrency import ConcurrencyLimiter, AdaptiveController
+from nile.downloading.blob_cache import BlobCache
+from nile.downloading.results import DownloadResults
+from nile.downloading.scheduler import POLICIES
+from nile.downloading.bandwidth import TokenBucket, SpeedControl
 from nile.utils.config import ConfigType
+from nile.utils.verify_cache import VerificationCache
 from nile import constants
 
 class DownloadManager:
+    default_workers = 6
+    default_async_connections = 256
+    # Upper bounds for --max-workers auto
+    max_auto_workers = 32
+    max_auto_connections = 256
+    # Files queued for the thread pool per worker thread
+    queued_per_worker = 4
+
     def __init__(self, config_manager, library_manager, session_manager, game):
         self.config = config_manager
         self.library_manager = library_manager
@@ -24,7 +43,7 @@ class DownloadManager:
 
         self.manifest = None
         self.old_manifest = None
-        self.threads = []
+        self.results = DownloadResults()
 
     def get_manifest(self):
         game_manifest = self.library_manager.get_game_manifest(self.game["id"])
@@ -46,17 +65,55 @@ class DownloadManager:
 
     def get_patchmanifest(self, comparison: manifest.ManifestComparison):
         self.logger.info("Generating patches, this might take a second...")
-        hash_pair_builder = hash_pairs.PatchBuilder(comparison)
+        # New files are downloaded directly, patches are needed only for updated ones
+        hash_pair_builder = hash_pairs.PatchBuilder(comparison, include_new=False)
         hash_pair_builder.build_hashpairs()
         patches = []
         for hash_pair in hash_pair_builder.get_next_hashes():
             patches.extend(
                 self.library_manager.get_patches(
                     self.game["id"], self.version, hash_pair
-                )
+                ) or []
             )
 
-        return patch_manifest.PatchManifest.build_patch_manifest(comparison, patches)
+        return patch_manifest.PatchManifest.build_patch_manifest(comparison, patches, include_new=False)
+
+    def plan_update(self, comparison: manifest.ManifestComparison):
+        """
+        Splits changed files into ones updated with a delta patch and ones downloaded whole
+        Returns (files, patches), patches being a list of (PatchFile, File)
+        """
+        files = list(comparison.new)
+        patches = []
+        if not comparison.updated:
+            return files, patches
+
+        available = dict()
+        for patch in self.get_patchmanifest(comparison).files:
+            if patch.patch_type == patch_manifest.PatchType.FUEL_PATCH and patch.patch_hash and patch.urls:
+                available[os.path.join(patch.path, patch.filename)] = patch
+        for old_file, new_file in comparison.updated:
+            patch = available.get(new_file.path)
+            if patch and patch.source_hash == old_file.hash.value:
+                patches.append((patch, new_file))
+            else:
+                files.append(new_file)
+        self.logger.debug(f"Patching {len(patches)} files, downloading {len(files)} files")
+        return files, patches
+
+    def get_required_size(self, total_size, patches, game_location):
+        """
+        Patched files are written next to the old ones before replacing them,
+        ones without room for that copy are patched in place and need only the patch
+        """
+        required_size = total_size
+        if not patches:
+            return required_size
+        free = shutil.disk_usage(game_location).free
+        for _, f in patches:
+            if f.size < free - required_size:
+                required_size += f.size
+        return required_size
 
     def get_installed_version(self):
         installed_games = self.config.get("installed")
@@ -74,7 +131,7 @@ class DownloadManager:
             old_manifest.parse(old_manifest_pb)
         return old_manifest
 
-    def download(self, force_verifying=False, base_install_path="", install_path=""):
+    def download(self, force_verifying=False, base_install_path="", install_path="", engine="threads", max_workers=None, full_verify=False, hardlink_duplicates=False, blob_cache_size=0, schedule="manifest", max_speed=None, progress_json=None) -> bool:
         game_location = base_install_path
         directory_name = self.game['product'].get("title") or self.game['product']['id']
         directory_name = dl_utils.save_directory_name(directory_name)
@@ -97,6 +154,29 @@ class DownloadManager:
             game_location = saved_location
 
         self.install_path = game_location
+        json_stream = None
+        if progress_json is not None:
+            try:
+                json_stream = os.fdopen(progress_json, "w", closefd=False)
+            except OSError as e:
+                self.logger.error(f"Unable to open progress stream: {e}")
+                return False
+
+        self.progress_bar = None
+        success = False
+        try:
+            success = self.update_game(
+                game_location, force_verifying, engine, max_workers, full_verify,
+                hardlink_duplicates, blob_cache_size, schedule, max_speed, json_stream
+            )
+            return success
+        finally:
+            # Stream readers get the outcome however the run ends
+            if json_stream:
+                progress_bar = self.progress_bar or ProgressBar(0, "", json_stream)
+                progress_bar.finish(success)
+
+    def update_game(self, game_location, force_verifying, engine, max_workers, full_verify, hardlink_duplicates, blob_cache_size, schedule, max_speed, json_stream) -> bool:
         if not force_verifying:
             self.manifest = self.get_manifest()
             self.old_manifest = self.load_installed_manifest()
@@ -107,62 +187,307 @@ class DownloadManager:
 
         if not self.manifest:
             self.logger.error("Unable to load manifest")
-            return
+            return False
         self.logger.debug(f"Number of packages: {len(self.manifest.packages)}")
 
         comparison = manifest.ManifestComparison.compare(
             self.manifest, self.old_manifest
         )
 
-        if len(comparison.new) == 0:
+        if len(comparison.new) == 0 and len(comparison.updated) == 0 and len(comparison.moved) == 0:
             self.logger.info("Game is up to date")
             self.finish(False)
-            return
-        total_size = sum(f.size for f in comparison.new)
+            return True
+        self.verify_cache = VerificationCache(
+            self.config, self.game["product"]["id"], full=full_verify
+        )
+        missing = self.apply_moves(comparison, game_location)
+        files, patches = self.plan_update(comparison)
+        files.extend(missing)
+        if len(files) == 0 and len(patches) == 0:
+            self.verify_cache.save()
+            self.remove_files(comparison.removed, game_location)
+            self.finish(force_verifying)
+            return True
+        total_size = sum(f.size for f in files) + sum(patch.download_size for patch, _ in patches)
         self.info()
+        readable_size = dl_utils.get_readable_size(total_size)
+        self.progress_bar = ProgressBar(
+            total_size, f"{round(readable_size[0],2)}{readable_size[1]}", json_stream
+        )
 
-        if not dl_utils.check_available_space(total_size, game_location):
+        required_size = self.get_required_size(total_size, patches, game_location)
+        if not dl_utils.check_available_space(required_size, game_location):
             self.logger.error("Not enough space available")
-            return
+            return False
+
+        if not self.prepare_layout(files, game_location):
+            return False
+
+        self.journal = DownloadJournal(game_location)
+        self.journal.load()
+        self.cancel_event = threading.Event()
+        self.thpool = None
+        self.hardlink_duplicates = hardlink_duplicates
+        self.blob_cache = None
+        if blob_cache_size:
+            self.blob_cache = BlobCache(int(blob_cache_size * 1024**3))
+        self.bandwidth = TokenBucket(self.get_max_speed(max_speed))
+        speed_control = SpeedControl(self.bandwidth, game_location)
+        speed_control.start()
 
-        readable_size = dl_utils.get_readable_size(total_size)
-
-        self.progress_bar = ProgressBar(total_size, f"{round(readable_size[0],2)}{readable_size[1]}")
         self.progress_bar.start()
 
-        self.thpool = ThreadPoolExecutor(max_workers=6)
-        for f in comparison.new:
-            file_path = os.path.join(
-                game_location, f.path.replace("\\", "/")
-            )
-            dir, _ = os.path.split(file_path)
-            if not os.path.exists(dir):
-                os.makedirs(dir)
-            url = urllib.parse.urlparse(self.downloadUrl)
-            url = url._replace(path=url.path + '/files/' + f.hash.value)
-            url = urllib.parse.urlunparse(url)
-            worker = DownloadWorker(url, f, game_location, self.session, self.progress_bar)
-            # worker.execute()
-            self.threads.append(self.thpool.submit(worker.execute))
-
-        while True:
-            is_done = False
-            for thread in self.threads:
-                is_done = thread.done()
-                if is_done == False:
-                    break
-            if is_done:
-                break
-            # self.progressbar.print()
-            sleep(0.5)
+        try:
+            success = self.download_files(files, game_location, engine, max_workers, schedule, patches)
+        except KeyboardInterrupt:
+            self.logger.warning("Download interrupted, progress is saved")
+            self.cancel_event.set()
+            if self.thpool:
+                self.thpool.shutdown(wait=True, cancel_futures=True)
+            raise
+        finally:
+            speed_control.stop()
+            self.progress_bar.stop()
+            self.progress_bar.join()
+            self.journal.save()
+            self.verify_cache.save()
+
+        self.remove_files(comparison.removed, game_location)
+
+        self.results.report()
+        if not success:
+            # Keep the previous state, next run continues from the journal
+            return False
+        self.journal.remove()
+        self.finish(force_verifying)
+        return True
 
-        for f in comparison.removed:
+    def remove_files(self, files, game_location):
+        for f in files:
             file_path = os.path.join(game_location, f.path.replace("\\", "/"))
             if os.path.exists(file_path):
                 os.remove(file_path)
 
-        self.progress_bar.completed = True
-        self.finish(force_verifying)
+    def apply_moves(self, comparison: manifest.ManifestComparison, game_location) -> list:
+        """
+        Creates moved files from their installed copies, files that are removed are renamed
+        Returns files that have to be downloaded because the old copy is missing or damaged
+        """
+        removed = {f.path for f in comparison.removed}
+        missing = []
+        reused = 0
+        for source, targets in comparison.moved.values():
+            source_path = os.path.join(game_location, source.path.replace("\\", os.sep))
+            if not self.is_installed(source, source_path):
+                missing.extend(targets)
+                continue
+            for i, f in enumerate(targets):
+                file_path = os.path.join(game_location, f.path.replace("\\", os.sep))
+                os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                if i == len(targets) - 1 and source.path in removed:
+                    os.replace(source_path, file_path)
+                else:
+                    dl_utils.clone_file(source_path, file_path)
+                self.verify_cache.add(f, file_path)
+                reused += 1
+        if reused:
+            self.logger.info(f"Reused {reused} moved files")
+        return missing
+
+    def is_installed(self, f, path) -> bool:
+        if not os.path.isfile(path):
+            return False
+        if self.verify_cache.is_verified(f, path):
+            return True
+        return f.hash.value == dl_utils.calculate_checksum(
+            dl_utils.get_hashing_function(f.hash.algorithm), path
+        )
+
+    def get_max_speed(self, max_speed) -> int:
+        """Returns speed limit in bytes per second, falls back to max_speed setting from the config"""
+        if max_speed is not None:
+            return max_speed
+        configured = self.config.get("settings", "max_speed")
+        if not configured:
+            return 0
+        try:
+            return dl_utils.parse_speed(configured)
+        except ValueError:
+            self.logger.warning(f"Ignoring invalid max_speed setting: {configured}")
+            return 0
+
+    def prepare_layout(self, files, game_location) -> bool:
+        """
+        Creates the directory tree in one pass and reserves space
+        for files that are going to be downloaded from scratch
+        """
+        directories = {
+            os.path.join(game_location, d.path.replace("\\", os.sep))
+            for d in self.manifest.packages[0].dirs
+        }
+        targets = dict()
+        for f in files:
+            file_path = os.path.join(game_location, f.path.replace("\\", os.sep))
+            directories.add(os.path.dirname(file_path))
+            # Duplicates are copied from the first file later
+            targets.setdefault(f.hash.value, (f, file_path))
+
+        existing = dict()
+        for directory in directories:
+            os.makedirs(directory, exist_ok=True)
+            existing[directory] = set(os.listdir(directory))
+
+        allocated = []
+        for f, file_path in targets.values():
+            directory, filename = os.path.split(file_path)
+            if filename in existing[directory] or filename + ".patch" in existing[directory]:
+                # Already installed or partially downloaded, worker will take care of it
+                continue
+            patch_path = file_path + ".patch"
+            try:
+                with open(patch_path, "wb") as patch_file:
+                    dl_utils.preallocate(patch_file, f.size)
+                allocated.append(patch_path)
+            except OSError as e:
+                if e.errno not in dl_utils.NO_SPACE_ERRORS:
+                    raise
+                self.logger.error(
+                    f"Unable to reserve space for {file_path}, not enough space available"
+                )
+                for path in allocated + [patch_path]:
+                    os.remove(path)
+                return False
+        self.logger.debug(f"Created {len(directories)} directories, reserved space for {len(allocated)} files")
+        return True
+
+    def download_files(self, files, game_location, engine="threads", max_workers=None, schedule="manifest", patches=()) -> bool:
+        if engine == "async" and not async_engine.aiohttp_available:
+            self.logger.warning("aiohttp is not installed, falling back to threads engine")
+            engine = "threads"
+
+        self.limiter = None
+        controller = None
+        if max_workers == "auto":
+            max_limit = self.max_auto_connections if engine == "async" else self.max_auto_workers
+            self.limiter = ConcurrencyLimiter(self.default_workers)
+            controller = AdaptiveController(self.limiter, max_limit=max_limit)
+            max_workers = max_limit
+        elif not max_workers:
+            max_workers = self.default_async_connections if engine == "async" else self.default_workers
+        self.logger.debug(f"Using {engine} engine with up to {max_workers} concurrent downloads")
+        self.session.set_pool_size(max_workers)
+
+        policy = POLICIES[schedule]()
+        self.results.add_listener(policy.completed)
+        if engine == "threads":
+            self.thpool = ThreadPoolExecutor(max_workers=max_workers)
+        if controller:
+            controller.start()
+        try:
+            for phase in policy.phases(files, game_location):
+                if self.cancel_event.is_set():
+                    break
+                if engine == "async":
+                    workers = self.create_workers(phase, game_location, threaded=False)
+                    downloader = async_engine.AsyncDownloadEngine(
+                        workers, self.session, self.results,
+                        max_connections=max_workers, limiter=self.limiter
+                    )
+                    downloader.run()
+                else:
+                    self.download_threaded(self.create_workers(phase, game_location), max_workers)
+            if patches and not self.cancel_event.is_set():
+                self.apply_patches(patches, game_location, engine, max_workers)
+            return self.results.success
+        finally:
+            if controller:
+                controller.stop()
+            if self.thpool:
+                self.thpool.shutdown(wait=False)
+
+    def apply_patches(self, patches, game_location, engine, max_workers):
+        """
+        Downloads deltas on threads regardless of the engine, patches are applied in a process pool
+        There are enough threads to keep every process busy while others wait for downloads
+        """
+        patch_workers = max(
+            max_workers if engine == "threads" else self.default_workers, cpu_count()
+        )
+        # Downloads are done at this point, the pool is idle
+        if self.thpool:
+            self.thpool.shutdown(wait=False)
+        self.thpool = ThreadPoolExecutor(max_workers=patch_workers)
+        # Every thread may hold a connection, keep them all alive
+        self.session.set_pool_size(patch_workers)
+        patch_pool = PatchPool(self.progress_bar)
+        patch_pool.start()
+        interrupted = False
+        try:
+            self.download_threaded(
+                self.create_patch_workers(patches, game_location, patch_pool), patch_workers
+            )
+        except KeyboardInterrupt:
+            interrupted = True
+            raise
+        finally:
+            patch_pool.shutdown(cancel=interrupted)
+
+    def download_threaded(self, workers, max_workers):
+        # Workers are created lazily, only a bounded number of files is queued at once
+        window = threading.Semaphore(max_workers * self.queued_per_worker)
+        for worker in workers:
+            # Timeout keeps Ctrl-C working on platforms where waiting isn't interruptible
+            while not window.acquire(timeout=1):
+                pass
+            future = self.submit(worker.execute)
+            future.add_done_callback(lambda _: window.release())
+
+        self.results.wait()
+
+    def create_workers(self, files, game_location, threaded=True):
+        # Files with the same content are downloaded once and copied locally
+        groups = dict()
+        for f in files:
+            groups.setdefault(f.hash.value, []).append(f)
+        self.logger.debug(f"Skipping download of {len(files) - len(groups)} duplicated files")
+
+        for group in groups.values():
+            worker = self.create_worker(group[0], game_location, threaded)
+            worker.duplicates = [
+                self.create_worker(f, game_location, threaded) for f in group[1:]
+            ]
+            yield worker
+
+    def create_worker(self, f, game_location, threaded=True):
+        url = urllib.parse.urlparse(self.downloadUrl)
+        url = url._replace(path=url.path + '/files/' + f.hash.value)
+        url = urllib.parse.urlunparse(url)
+        return DownloadWorker(
+            url, f, game_location, self.session, self.progress_bar,
+            **self.get_worker_options(threaded)
+        )
+
+    def create_patch_workers(self, patches, game_location, patch_pool=None):
+        for patch, f in patches:
+            yield PatchWorker(
+                patch, f, self.create_worker(f, game_location), game_location,
+                self.session, self.progress_bar, patch_pool=patch_pool, **self.get_worker_options()
+            )
+
+    def get_worker_options(self, threaded=True):
+        return dict(
+            journal=self.journal, cancel_event=self.cancel_event,
+            submit=self.submit if threaded else None, limiter=self.limiter,
+            verify_cache=self.verify_cache, hardlink_duplicates=self.hardlink_duplicates,
+            blob_cache=self.blob_cache, bandwidth=self.bandwidth, results=self.results
+        )
+
+    def submit(self, fn, *args):
+        future = self.thpool.submit(fn, *args)
+        # All tasks are DownloadWorker methods
+        self.results.track(future, fn.__self__.data.path)
+        return future
 
     def info(self, json_format=False):
         self.manifest = self.get_manifest()
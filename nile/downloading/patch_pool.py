@@ -0,0 +1,159 @@
+import io
+import os
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+from nile.models.patcher import Patcher, InPlacePatcher
+from nile.utils.download import calculate_checksum, get_hashing_function
+
+# Shared counter of bytes written by patches, set in pool processes
+_written = None
+
+
+def init_process(written):
+    global _written
+    _written = written
+
+
+class ProgressReporter:
+    """Adds to a shared counter in batches, so processes rarely contend for its lock"""
+
+    batch_size = 4 * 1024 * 1024
+
+    def __init__(self, counter):
+        self.counter = counter
+        self.pending = 0
+
+    def add(self, amount):
+        self.pending += amount
+        if self.pending >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.counter is None or not self.pending:
+            return
+        with self.counter.get_lock():
+            self.counter.value += self.pending
+        self.pending = 0
+
+
+def run_patcher(patcher_class, *files, progress=None):
+    """Reports to the shared counter when called in a pool process"""
+    if progress is None:
+        reporter = ProgressReporter(_written)
+        progress = reporter.add
+    else:
+        reporter = None
+    patcher_class(*files, progress=progress).run()
+    if reporter:
+        reporter.flush()
+
+
+def apply_patch_file(source_path, patch_path, target_path, hash_algorithm, progress=None) -> str:
+    """Writes patched file to target_path, returns its hash"""
+    run_patcher(
+        Patcher, open(source_path, "rb"), open(patch_path, "rb"), open(target_path, "wb"),
+        progress=progress
+    )
+    return calculate_checksum(get_hashing_function(hash_algorithm), target_path)
+
+
+class PipeReader(io.RawIOBase):
+    """Readable stream of data sent through a Connection, empty message ends it"""
+
+    def __init__(self, connection):
+        super().__init__()
+        self.connection = connection
+        self.message = b""
+        self.position = 0
+        self.eof = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self.position == len(self.message):
+            if self.eof:
+                return 0
+            self.message = self.connection.recv_bytes()
+            self.position = 0
+            if not self.message:
+                self.eof = True
+                return 0
+        size = min(len(buffer), len(self.message) - self.position)
+        buffer[:size] = self.message[self.position:self.position + size]
+        self.position += size
+        return size
+
+
+def apply_patch_stream(connection, source_path, target_path, hash_algorithm, progress=None) -> str:
+    """
+    Writes patched file to target_path while the patch is received through connection
+    Closing the connection when the patcher stops lets the sender know
+    """
+    try:
+        # Tells the sender patcher has its end of the pipe
+        connection.send_bytes(b"")
+        run_patcher(
+            Patcher, open(source_path, "rb"), PipeReader(connection), open(target_path, "wb"),
+            progress=progress
+        )
+    finally:
+        connection.close()
+    return calculate_checksum(get_hashing_function(hash_algorithm), target_path)
+
+
+def apply_patch_in_place(path, patch_path, hash_algorithm, progress=None):
+    """Patches path itself, returns hash of the result or None if the patch doesn't allow it"""
+    with open(patch_path, "rb") as f:
+        if not InPlacePatcher.is_safe(f, os.path.getsize(path)):
+            return None
+    run_patcher(InPlacePatcher, open(path, "r+b"), open(patch_path, "rb"), progress=progress)
+    return calculate_checksum(get_hashing_function(hash_algorithm), path)
+
+
+class PatchPool(threading.Thread):
+    """
+    Applies patches in worker processes, one per core, so decompression,
+    merging and hashing of several files run in parallel
+    Bytes written by the processes are forwarded to the ProgressBar
+    """
+
+    interval = 0.5  # seconds
+
+    def __init__(self, progress, workers=None):
+        super().__init__(daemon=True)
+        self.progress = progress
+        self.logger = logging.getLogger("PATCHPOOL")
+        # Download threads are running, forking them is not safe
+        context = multiprocessing.get_context("spawn")
+        self.written = context.Value("q", 0)
+        self.reported = 0
+        self.executor = ProcessPoolExecutor(
+            max_workers=workers or multiprocessing.cpu_count(),
+            mp_context=context,
+            initializer=init_process,
+            initargs=(self.written,),
+        )
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.report()
+
+    def report(self):
+        with self.written.get_lock():
+            written = self.written.value
+        self.progress.update_bytes_written(written - self.reported)
+        self.reported = written
+
+    def submit(self, function, *args) -> Future:
+        """Runs one of apply_patch_* functions in a pool process"""
+        return self.executor.submit(function, *args)
+
+    def shutdown(self, cancel=False):
+        """Waits for running patches, unless cancelled, then queued ones are dropped too"""
+        self.stopped.set()
+        self.executor.shutdown(wait=not cancel, cancel_futures=cancel)
+        self.report()
@@ -0,0 +1,255 @@
+import os
+import shutil
+import multiprocessing
+import requests
+from concurrent.futures import BrokenExecutor, Future, ThreadPoolExecutor, wait
+from nile.downloading.worker import DownloadWorker
+from nile.downloading.retry import DownloadError
+from nile.downloading.patch_pool import PatchPool, apply_patch_file, apply_patch_in_place, apply_patch_stream
+from nile.models.manifest import File
+from nile.models.patch_manifest import PatchFile
+from nile.utils.download import get_hashing_function
+
+
+class DeltaHash:
+    def __init__(self, value, algorithm):
+        self.value = value
+        self.algorithm = algorithm
+
+
+class Delta:
+    """Describes patch payload like a manifest File, so DownloadWorker can fetch it"""
+
+    def __init__(self, patch: PatchFile, target: File):
+        self.path = target.path
+        self.size = patch.download_size
+        self.hash = DeltaHash(patch.patch_hash, patch.patch_hash_type)
+
+
+class PatcherStopped(Exception):
+    """Patcher quit before receiving the whole patch"""
+
+
+class PatchWorker(DownloadWorker):
+    """
+    Updates a file by applying FUEL_PATCH delta to the installed file
+    Delta is streamed straight into the patcher, unless the file is patched in place,
+    which needs the whole delta in path + ".patch" first
+    Falls back to downloading the whole file if the patch can't be used
+    """
+
+    # How often to check if patcher died before taking the stream
+    poll_interval = 0.5  # seconds
+
+    def __init__(self, patch: PatchFile, target: File, fallback: DownloadWorker, path, session_manager, progress, patch_pool: PatchPool = None, **kwargs):
+        super().__init__(patch.urls[0], Delta(patch, target), path, session_manager, progress, **kwargs)
+        self.patch = patch
+        self.target = target
+        # Worker downloading the whole target file
+        self.fallback = fallback
+        # Optional PatchPool, patches are applied on this thread without it
+        self.patch_pool = patch_pool
+
+    def execute(self) -> bool:
+        file_path = self.get_path()
+        if self.journal and self.journal.is_completed(self.target, file_path):
+            self.progress.update_downloaded_size(self.data.size)
+            self.mark_completed(file_path)
+            return True
+        if self.journal and self.journal.is_in_place(self.target):
+            self.logger.warning(f"Patching {self.target.path} in place was interrupted, downloading the whole file")
+            return self.download_whole()
+        if not os.path.exists(file_path):
+            self.logger.warning(f"{self.target.path} is missing, downloading the whole file")
+            return self.download_whole()
+        if self.needs_in_place(file_path):
+            return self.download_patch(file_path)
+        return self.stream(file_path)
+
+    def download_patch(self, path) -> bool:
+        """Downloads the whole patch to path + ".patch" first, for patching in place"""
+        try:
+            return self.download(path)
+        except (DownloadError, requests.RequestException) as e:
+            return self.patch_unavailable(e)
+
+    def download_segment(self, path, start, end, written) -> bool:
+        try:
+            return super().download_segment(path, start, end, written)
+        except (DownloadError, requests.RequestException) as e:
+            # Only the last segment raises, the file falls back once
+            return self.patch_unavailable(e)
+
+    def patch_unavailable(self, error) -> bool:
+        if self.is_cancelled():
+            return False
+        self.logger.warning(f"Unable to download patch for {self.target.path}: {error}, downloading the whole file")
+        return self.download_whole()
+
+    def stream(self, path) -> bool:
+        """Applies the patch to path + ".new" while it downloads"""
+        new_path = path + ".new"
+        connection, patcher_connection = multiprocessing.Pipe()
+        future = self.start_patch(
+            apply_patch_stream, patcher_connection, path, new_path, self.target.hash.algorithm
+        )
+        patch_hash = target_hash = None
+        try:
+            self.wait_started(connection, future)
+            if self.patch_pool:
+                # Pool process has its own end, its exit has to break the pipe
+                patcher_connection.close()
+            patch_hash = self.send_patch(connection)
+            if patch_hash is None:
+                return False
+            self.feed(connection, b"")
+            target_hash = future.result()
+        except (DownloadError, requests.RequestException) as e:
+            # Retries are used up or the patch is gone from the server
+            self.logger.warning(f"Unable to download patch for {self.target.path}: {e}")
+        except (PatcherStopped, OSError, ValueError, EOFError, BrokenExecutor) as e:
+            if not isinstance(e, PatcherStopped) and patch_hash is None:
+                # Download failed, not the patcher
+                raise
+            wait([future])
+            self.logger.debug(f"Patcher failed for {self.target.path}: {future.exception()!r}")
+        finally:
+            connection.close()
+            wait([future])
+            valid = patch_hash == self.data.hash.value and target_hash == self.target.hash.value
+            if not valid and os.path.exists(new_path):
+                os.remove(new_path)
+
+        if not valid:
+            self.logger.warning(f"Failed to patch {self.target.path}, downloading the whole file")
+            return self.download_whole()
+        os.replace(new_path, path)
+        self.mark_completed(path)
+        return True
+
+    def download_whole(self) -> bool:
+        """Falls back to the whole file, progress total counted only the patch"""
+        self.reset_progress()
+        self.progress.add_total(self.target.size - self.data.size)
+        return self.fallback.execute()
+
+    def wait_started(self, connection, future: Future):
+        while not connection.poll(self.poll_interval):
+            if future.done():
+                raise PatcherStopped()
+        connection.recv_bytes()
+
+    def feed(self, connection, data):
+        try:
+            connection.send_bytes(data)
+        except OSError as e:
+            raise PatcherStopped() from e
+
+    def send_patch(self, connection):
+        """
+        Sends the patch to patcher, requests that fail continue where they stopped
+        Returns hash of the patch, None if cancelled
+        """
+        patch_hash = get_hashing_function(self.data.hash.algorithm)()
+        received = 0
+        attempt = 0
+        while True:
+            try:
+                with self.slot():
+                    response = self.request({"Range": f"bytes={received}-"} if received else dict())
+                    # Server ignored the range, drop what patcher already has
+                    skip = received if response.status_code != 206 else 0
+                    for data in response.iter_content(chunk_size=self.get_chunk_size(self.data.size)):
+                        if self.is_cancelled():
+                            response.close()
+                            return None
+                        self.throttle(len(data))
+                        if self.limiter:
+                            self.limiter.report_bytes(len(data))
+                        if skip:
+                            dropped = min(skip, len(data))
+                            skip -= dropped
+                            data = data[dropped:]
+                            if not data:
+                                continue
+                        self.add_progress(len(data))
+                        patch_hash.update(data)
+                        self.feed(connection, data)
+                        received += len(data)
+                return patch_hash.hexdigest()
+            except PatcherStopped:
+                raise
+            except Exception as e:
+                if self.is_cancelled():
+                    return None
+                delay = self.get_retry_delay(e, attempt)
+                if delay is None:
+                    raise
+                attempt += 1
+                self.wait(delay)
+
+    def finalize(self, path) -> bool:
+        patch_path = path + ".patch"
+        self.check_download(patch_path)
+        if not self.apply_patch(path):
+            self.logger.warning(f"Failed to patch {self.target.path}, downloading the whole file")
+            return self.download_whole()
+        self.mark_completed(path)
+        return True
+
+    def apply_patch(self, path) -> bool:
+        """
+        Patches huge files in place if possible, others are written to path + ".new"
+        which replaces path if the result is valid
+        """
+        patch_path = path + ".patch"
+        new_path = path + ".new"
+        algorithm = self.target.hash.algorithm
+        try:
+            if self.needs_in_place(path):
+                self.journal.mark_in_place(self.target)
+                target_hash = self.run_patch(apply_patch_in_place, path, patch_path, algorithm)
+                if target_hash is not None:
+                    return target_hash == self.target.hash.value
+                self.logger.debug(f"Patch of {self.target.path} can't be applied in place")
+            target_hash = self.run_patch(apply_patch_file, path, patch_path, new_path, algorithm)
+        except (OSError, ValueError, BrokenExecutor) as e:
+            self.logger.debug(f"Patcher failed for {self.target.path}: {e!r}")
+            if os.path.exists(new_path):
+                os.remove(new_path)
+            return False
+        finally:
+            os.remove(patch_path)
+
+        if target_hash != self.target.hash.value:
+            os.remove(new_path)
+            return False
+        os.replace(new_path, path)
+        return True
+
+    def needs_in_place(self, path) -> bool:
+        # Journal is what makes an interrupted in place patch detectable
+        if not self.journal:
+            return False
+        # Only when there is no room for the patched copy
+        return shutil.disk_usage(os.path.dirname(path)).free < self.target.size
+
+    def run_patch(self, function, *args):
+        return self.start_patch(function, *args).result()
+
+    def start_patch(self, function, *args) -> Future:
+        """Runs one of apply_patch_* functions in the PatchPool, or a thread without it"""
+        if self.patch_pool:
+            return self.patch_pool.submit(function, *args)
+        executor = ThreadPoolExecutor(max_workers=1)
+        future = executor.submit(function, *args, progress=self.progress.update_bytes_written)
+        executor.shutdown(wait=False)
+        return future
+
+    def mark_completed(self, path):
+        if self.journal:
+            self.journal.mark_completed(self.target, path)
+        if self.verify_cache:
+            self.verify_cache.add(self.target, path)
+        if self.results:
+            self.results.file_completed(self.target)
@@ -1,87 +1,178 @@
+import json
 import threading
 import logging
-from time import sleep, time
+from time import time
+
+
+class Counters:
+    """Progress of a single thread, only that thread writes to it"""
+
+    __slots__ = ("downloaded", "received", "written")
+
+    def __init__(self):
+        self.downloaded = 0
+        # Part of downloaded that came over the network
+        self.received = 0
+        self.written = 0
 
 
 class ProgressBar(threading.Thread):
-    def __init__(self, max_val, total_readable_size):
+    """
+    Reports progress every second, threads count into their own Counters
+    so updates don't need a lock and nothing gets lost between reports.
+    Speeds are smoothed with EWMA. With json_stream every report is also
+    written to it as a JSON line, finish() ends the stream with the outcome
+    """
+
+    interval = 1  # seconds
+    # Weight of the newest sample in smoothed speeds
+    smoothing = 0.3
+
+    def __init__(self, max_val, total_readable_size, json_stream=None):
         self.logger = logging.getLogger("PROGRESS")
-        self.downloaded = 0
         self.total = max_val
         self.started_at = time()
-        self.last_update = time()
+        self.last_update = self.started_at
         self.total_readable_size = total_readable_size
+        self.json_stream = json_stream
         self.completed = False
+        self.stopped = threading.Event()
+        self.total_lock = threading.Lock()
 
-        self.written_total = 0
+        self.local = threading.local()
+        self.counters = []
 
-        self.written_since_last_update = 0
-        self.downloaded_since_last_update = 0
+        # Sums as of the last report
+        self.downloaded = 0
+        self.received = 0
+        self.written_total = 0
+        self.download_speed = None
+        self.write_speed = None
 
         super().__init__(target=self.print_progressbar)
 
+    def stop(self):
+        self.completed = True
+        self.stopped.set()
+
     def print_progressbar(self):
-        while True:
-            if self.completed:
-                break
-            percentage = (self.downloaded / self.total) * 100
-            running_time = time() - self.started_at
-            runtime_h = int(running_time // 3600)
-            runtime_m = int((running_time % 3600) // 60)
-            runtime_s = int((running_time % 3600) % 60)
-
-            time_since_last_update = time() - self.last_update
-            if time_since_last_update == 0:
-                time_since_last_update = 1
-
-            # average_speed = self.downloaded / running_time
-
-            if percentage > 0:
-                estimated_time = (100 * running_time) / percentage - running_time
-            else:
-                estimated_time = 0
-
-            estimated_h = int(estimated_time // 3600)
-            estimated_time = estimated_time % 3600
-            estimated_m = int(estimated_time // 60)
-            estimated_s = int(estimated_time % 60)
-
-            write_speed = self.written_since_last_update / time_since_last_update
-            download_speed = self.downloaded_since_last_update / time_since_last_update
-
-            self.written_total += self.written_since_last_update
-            self.downloaded += self.downloaded_since_last_update
-
-            self.read_since_last_update = self.written_since_last_update = 0
-            self.decompressed_since_last_update = self.downloaded_since_last_update = 0
-
-            self.logger.info(
-                f"= Progress: {percentage:.02f} {self.downloaded}/{self.total}, "
-                + f"Running for: {runtime_h:02d}:{runtime_m:02d}:{runtime_s:02d}, "
-                + f"ETA: {estimated_h:02d}:{estimated_m:02d}:{estimated_s:02d}"
-            )
-
-            self.logger.info(
-                f"= Downloaded: {self.downloaded / 1024 / 1024:.02f} MiB, "
-                f"Written: {self.written_total / 1024 / 1024:.02f} MiB"
-            )
-
-            self.logger.info(
-                f" + Download\t- {download_speed / 1024 / 1024:.02f} MiB/s"
-            )
-
-            self.logger.info(
-                f" + Disk\t- {write_speed / 1024 / 1024:.02f} MiB/s"
-            )
-
-            self.last_update = time()
-            sleep(1)
+        while not self.stopped.wait(self.interval):
+            if not self.is_listened():
+                continue
+            self.update()
+            self.log()
+            self.write_json("progress")
+
+    def finish(self, success):
+        """Writes the terminal "finished" or "failed" event, once the thread is stopped"""
+        if not self.json_stream:
+            return
+        self.update()
+        self.write_json("finished" if success else "failed")
+
+    def is_listened(self) -> bool:
+        return self.json_stream is not None or self.logger.isEnabledFor(logging.INFO)
+
+    def update(self):
+        now = time()
+        elapsed = now - self.last_update or 1
+        counters = list(self.counters)
+        downloaded = sum(c.downloaded for c in counters)
+        received = sum(c.received for c in counters)
+        written = sum(c.written for c in counters)
+
+        self.download_speed = self.smooth(self.download_speed, (received - self.received) / elapsed)
+        self.write_speed = self.smooth(self.write_speed, (written - self.written_total) / elapsed)
+        self.downloaded = downloaded
+        self.received = received
+        self.written_total = written
+        self.last_update = now
+
+    def smooth(self, average, sample):
+        if average is None:
+            return sample
+        return average + self.smoothing * (sample - average)
+
+    def get_percentage(self):
+        return (self.downloaded / self.total) * 100 if self.total else 100
+
+    def get_eta(self):
+        """Seconds left at the current speed, None until there is any"""
+        if not self.download_speed:
+            return None
+        return max(self.total - self.downloaded, 0) / self.download_speed
+
+    def log(self):
+        if not self.logger.isEnabledFor(logging.INFO):
+            return
+        running_time = self.last_update - self.started_at
+        self.logger.info(
+            f"= Progress: {self.get_percentage():.02f} {self.downloaded}/{self.total}, "
+            + f"Running for: {self.format_time(running_time)}, "
+            + f"ETA: {self.format_time(self.get_eta() or 0)}"
+        )
+
+        self.logger.info(
+            f"= Downloaded: {self.downloaded / 1024 / 1024:.02f} MiB, "
+            f"Written: {self.written_total / 1024 / 1024:.02f} MiB"
+        )
+
+        self.logger.info(
+            f" + Download\t- {self.download_speed / 1024 / 1024:.02f} MiB/s"
+        )
+
+        self.logger.info(
+            f" + Disk\t- {self.write_speed / 1024 / 1024:.02f} MiB/s"
+        )
+
+    @staticmethod
+    def format_time(seconds):
+        seconds = int(seconds)
+        return f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+    def write_json(self, event):
+        if not self.json_stream:
+            return
+        eta = self.get_eta()
+        line = json.dumps(dict(
+            event=event,
+            downloaded=self.downloaded,
+            total=self.total,
+            percentage=round(self.get_percentage(), 2),
+            written=self.written_total,
+            download_speed=int(self.download_speed or 0),
+            disk_speed=int(self.write_speed or 0),
+            elapsed=round(self.last_update - self.started_at, 1),
+            eta=None if eta is None else round(eta, 1),
+        ))
+        try:
+            self.json_stream.write(line + "\n")
+            self.json_stream.flush()
+        except OSError:
+            self.logger.warning("Progress stream was closed")
+            self.json_stream = None
+
+    def get_counters(self) -> Counters:
+        try:
+            return self.local.counters
+        except AttributeError:
+            counters = self.local.counters = Counters()
+            # Appending is atomic, the reporter iterates over a copy
+            self.counters.append(counters)
+            return counters
+
+    def add_total(self, addition):
+        """For downloads that turned out bigger than planned, like patches replaced by whole files"""
+        with self.total_lock:
+            self.total += addition
 
     def update_downloaded_size(self, addition):
-        self.downloaded += addition
+        self.get_counters().downloaded += addition
 
     def update_download_speed(self, addition):
-        self.downloaded_since_last_update += addition
+        counters = self.get_counters()
+        counters.downloaded += addition
+        counters.received += addition
 
     def update_bytes_written(self, addition):
-        self.written_since_last_update += addition
\ No newline at end of file
+        self.get_counters().written += addition
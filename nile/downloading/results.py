@@ -0,0 +1,90 @@
+import logging
+import threading
+from collections import Counter
+from concurrent.futures import Future
+from nile.downloading.retry import DownloadError
+
+
+class DownloadResults:
+    """
+    Collects outcome of download tasks as they finish
+    Failures are reported right away and kept for the final summary
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger("DOWNLOAD")
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.completed = 0
+        # list of (file path, reason)
+        self.failed = []
+        # error kind -> number of failed attempts, including the retried ones
+        self.errors = Counter()
+        self.retries = 0
+        self.finished = threading.Event()
+        self.finished.set()
+        # Called with every File that is fully installed
+        self.listeners = []
+
+    @property
+    def success(self) -> bool:
+        return not self.failed
+
+    def track(self, future: Future, name):
+        with self.lock:
+            self.pending += 1
+            self.finished.clear()
+        future.add_done_callback(lambda done: self.on_done(done, name))
+
+    def on_done(self, future: Future, name):
+        if future.cancelled():
+            self.record(name, False, "cancelled")
+        elif future.exception():
+            self.record_error(name, future.exception())
+        else:
+            self.record(name, future.result())
+        with self.lock:
+            self.pending -= 1
+            if self.pending == 0:
+                self.finished.set()
+
+    def count_error(self, kind, retrying):
+        with self.lock:
+            self.errors[kind] += 1
+            if retrying:
+                self.retries += 1
+
+    def record_error(self, name, error):
+        reason = str(error) if isinstance(error, DownloadError) else repr(error)
+        self.record(name, False, reason)
+
+    def record(self, name, success, reason="cancelled"):
+        with self.lock:
+            if success:
+                self.completed += 1
+                return
+            self.failed.append((name, reason))
+        if reason != "cancelled":
+            self.logger.error(f"Failed to download {name}: {reason}")
+
+    def add_listener(self, callback):
+        self.listeners.append(callback)
+
+    def file_completed(self, file):
+        for callback in self.listeners:
+            callback(file)
+
+    def wait(self):
+        # Timeout keeps Ctrl-C working on platforms where waiting isn't interruptible
+        while not self.finished.wait(1):
+            pass
+
+    def report(self):
+        if self.errors:
+            summary = ", ".join(f"{kind}: {count}" for kind, count in self.errors.most_common())
+            self.logger.info(f"Download errors: {summary}, retried {self.retries} times")
+        if not self.failed:
+            return
+        self.logger.error(f"{len(self.failed)} files failed to download:")
+        for name, reason in self.failed:
+            self.logger.error(f" - {name}: {reason}")
@@ -0,0 +1,63 @@
+import random
+import asyncio
+import requests
+
+aiohttp_available = True
+
+try:
+    import aiohttp
+except Exception:
+    aiohttp_available = False
+
+# HTTP statuses worth another attempt, other client errors won't go away by retrying
+RETRY_STATUSES = {408, 425, 429}
+
+
+class DownloadError(Exception):
+    """Failed download attempt, kind is used to group errors in the summary"""
+
+    def __init__(self, kind, message, retryable=True):
+        super().__init__(message)
+        self.kind = kind
+        self.retryable = retryable
+
+
+class HTTPStatusError(DownloadError):
+    def __init__(self, status):
+        super().__init__(
+            "http", f"HTTP {status}", retryable=status >= 500 or status in RETRY_STATUSES
+        )
+
+
+class RangeNotSupported(DownloadError):
+    """Server answered a ranged request with the whole file"""
+
+    def __init__(self):
+        super().__init__("range", "Server doesn't support ranged requests", retryable=False)
+
+
+def classify_error(error):
+    """Returns (kind, retryable) of an exception raised while downloading, None for unexpected ones"""
+    if isinstance(error, DownloadError):
+        return error.kind, error.retryable
+    # Network errors of both libraries are OSError subclasses, check them first
+    if isinstance(error, requests.Timeout):
+        return "timeout", True
+    if isinstance(error, requests.RequestException):
+        return "connection", True
+    if isinstance(error, (TimeoutError, asyncio.TimeoutError)):
+        return "timeout", True
+    if aiohttp_available:
+        if isinstance(error, aiohttp.ClientResponseError):
+            return "http", error.status >= 500 or error.status in RETRY_STATUSES
+        if isinstance(error, aiohttp.ClientError):
+            return "connection", True
+    if isinstance(error, OSError):
+        # Disk errors like ENOSPC need user's attention
+        return "disk", False
+    return None
+
+
+def get_backoff(attempt, base, maximum) -> float:
+    """Exponential backoff with full jitter, attempt counts from 0"""
+    return random.uniform(0, min(maximum, base * 2**attempt))
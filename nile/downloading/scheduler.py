@@ -0,0 +1,117 @@
+import os
+import logging
+import threading
+import json5
+
+
+def normalize_path(path):
+    return path.replace("\\", "/").lower()
+
+
+class SchedulingPolicy:
+    """
+    Decides in which order files are downloaded
+    Files are split into phases, each phase is fully downloaded before the next one starts
+    """
+
+    name = "manifest"
+
+    def __init__(self):
+        self.logger = logging.getLogger("SCHEDULER")
+
+    def order(self, files) -> list:
+        return list(files)
+
+    def phases(self, files, game_location):
+        yield self.order(files)
+
+    def completed(self, file):
+        """Called from download threads with every File that is fully installed"""
+
+
+class LargestFirst(SchedulingPolicy):
+    """Starting the biggest files first keeps one huge file from dominating the end of the download"""
+
+    name = "largest-first"
+
+    def order(self, files) -> list:
+        return sorted(files, key=lambda f: f.size, reverse=True)
+
+
+class SmallestFirst(SchedulingPolicy):
+    """Completes as many files as possible early on"""
+
+    name = "smallest-first"
+
+    def order(self, files) -> list:
+        return sorted(files, key=lambda f: f.size)
+
+
+class PlayableFirst(LargestFirst):
+    """
+    Downloads fuel.json first, then the executable it points to together
+    with the rest of its directory, everything else follows largest first
+    Only fuel.json is a separate phase, the rest is queued right behind the launch files
+    """
+
+    name = "playable-first"
+
+    def __init__(self):
+        super().__init__()
+        self.lock = threading.Lock()
+        # Normalized paths of launch files that are not installed yet
+        self.pending = set()
+
+    def phases(self, files, game_location):
+        fuel = [f for f in files if normalize_path(f.path) == "fuel.json"]
+        if fuel:
+            yield fuel
+            files = [f for f in files if normalize_path(f.path) != "fuel.json"]
+
+        command = self.get_command(game_location)
+        if not command:
+            yield self.order(files)
+            return
+        command_dir = os.path.dirname(normalize_path(command))
+        critical = [
+            f for f in files if os.path.dirname(normalize_path(f.path)) == command_dir
+        ]
+        critical_ids = {id(f) for f in critical}
+        rest = [f for f in files if id(f) not in critical_ids]
+        with self.lock:
+            self.pending = {normalize_path(f.path) for f in critical}
+        if not critical:
+            self.log_launchable(game_location, command)
+        yield self.order(critical) + self.order(rest)
+
+    def completed(self, file):
+        with self.lock:
+            if not self.pending:
+                return
+            self.pending.discard(normalize_path(file.path))
+            if self.pending:
+                return
+        self.logger.info("Files required to launch the game are downloaded")
+
+    def log_launchable(self, game_location, command):
+        if os.path.exists(os.path.join(game_location, command.replace("\\", os.sep))):
+            self.logger.info("Files required to launch the game are downloaded")
+
+    def get_command(self, game_location):
+        """Returns Main.Command path from fuel.json"""
+        fuel_path = os.path.join(game_location, "fuel.json")
+        if not os.path.exists(fuel_path):
+            return None
+        try:
+            with open(fuel_path, "r") as f:
+                fuel = json5.loads(f.read())
+            return fuel["Main"]["Command"]
+        except (OSError, ValueError, KeyError, TypeError):
+            self.logger.warning("Unable to read launch command from fuel.json")
+            return None
+
+
+POLICIES = {
+    policy.name: policy
+    for policy in (SchedulingPolicy, LargestFirst, SmallestFirst, PlayableFirst)
+}
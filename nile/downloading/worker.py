@@ -1,76 +1,423 @@
 import os
 import shutil
-from nile.utils.download import calculate_checksum, get_hashing_function
-#from nile.models.patcher import Patcher
+import logging
+import threading
+from contextlib import nullcontext
+from time import time, sleep
+from nile.utils.download import calculate_checksum, get_hashing_function, preallocate, clone_file, OrderedHasher
+from nile.downloading.retry import DownloadError, HTTPStatusError, RangeNotSupported, classify_error, get_backoff
 from nile.models.manifest import File
 
 
 class DownloadWorker:
-    def __init__(self, download_url, file_data, path, session_manager, progress):
+    # Files bigger than that are split into ranges downloaded in parallel
+    segment_threshold = 256 * 1024 * 1024
+    segment_size = 64 * 1024 * 1024
+    # Attempts made after the first one fails
+    retries = 3
+    backoff_base = 1  # seconds
+    backoff_max = 30
+    # Stalled connections fail and get retried instead of hanging the worker
+    timeout = (10, 60)  # connect, read seconds
+
+    def __init__(self, download_url, file_data, path, session_manager, progress, journal=None, cancel_event=None, submit=None, limiter=None, verify_cache=None, hardlink_duplicates=False, blob_cache=None, bandwidth=None, results=None):
         self.download_url = download_url
         self.data: File  = file_data
         self.path = path
         self.session = session_manager.session
         self.progress = progress
+        self.journal = journal
+        self.cancel_event = cancel_event
+        # Callable used to schedule segment downloads on the same pool
+        self.submit = submit
+        # Optional ConcurrencyLimiter shared by all workers
+        self.limiter = limiter
+        # Optional VerificationCache of the game
+        self.verify_cache = verify_cache
+        # Workers of files with the same hash, copied from this one once it's done
+        self.duplicates = []
+        self.hardlink_duplicates = hardlink_duplicates
+        # Optional BlobCache shared between games
+        self.blob_cache = blob_cache
+        # Optional TokenBucket shared by all workers
+        self.bandwidth = bandwidth
+        # Optional DownloadResults collecting error statistics
+        self.results = results
+        self.logger = logging.getLogger("WORKER")
+
+        # Guards segment state and reported progress
+        self.lock = threading.Lock()
+        self.segments_remaining = 0
+        self.segments_failed = False
+        self.segments_error = None
+        # Cleared once the server ignores Range, the file is then downloaded in one piece
+        self.ranges_supported = True
+        # Failed attempts of the whole file
+        self.attempt = 0
+        # Progress reported by the current attempt
+        self.reported = 0
+        # Hashes data as it's written, so files don't need to be read again
+        self.hasher = None
 
-    def execute(self):
-        file_path = os.path.join(
+    def get_path(self):
+        return os.path.join(
             self.path, self.data.path.replace("\\", os.sep)
         )
-        if os.path.exists(file_path):
-            if self.verify_downloaded_file(file_path):
-                return
-        self.get_file(file_path)
-        if not self.verify_downloaded_file(file_path):
-            print(f"Checksum error for {file_path}")
+
+    def execute(self) -> bool:
+        file_path = self.get_path()
+        if self.journal and self.journal.is_completed(self.data, file_path):
+            self.progress.update_downloaded_size(self.data.size)
+            self.mark_completed(file_path)
+            return True
+        if self.check_existing(file_path) or self.fetch_cached(file_path):
+            self.progress.update_downloaded_size(self.data.size)
+            self.mark_completed(file_path)
+            return True
+        return self.download(file_path)
+
+    def download(self, path) -> bool:
+        while True:
+            try:
+                if self.submit and self.ranges_supported and self.data.size > self.segment_threshold:
+                    return self.start_segments(path)
+                return self.get_file(path) and self.finalize(path)
+            except Exception as e:
+                if self.is_cancelled():
+                    return False
+                if not self.prepare_retry(e):
+                    raise
+
+    def get_retry_delay(self, error, attempt):
+        """Returns seconds to wait before another attempt, None if the error is final"""
+        classified = classify_error(error)
+        if classified is None:
+            return None
+        kind, retryable = classified
+        retrying = retryable and attempt < self.retries
+        if self.results:
+            self.results.count_error(kind, retrying)
+        if not retrying:
+            return None
+        delay = get_backoff(attempt, self.backoff_base, self.backoff_max)
+        self.logger.warning(
+            f"{self.data.path}: {error}, retrying in {delay:.1f}s ({attempt + 1}/{self.retries})"
+        )
+        return delay
+
+    def prepare_retry(self, error) -> bool:
+        """Waits before downloading the whole file again, returns False if the error is final"""
+        delay = self.get_retry_delay(error, self.attempt)
+        if delay is None:
+            return False
+        self.attempt += 1
+        self.reset_progress()
+        self.wait(delay)
+        return True
+
+    def finalize(self, path) -> bool:
+        patch_path = path + ".patch"
+        self.check_download(patch_path)
+        shutil.move(patch_path, path)
+        if self.blob_cache:
+            self.blob_cache.store(self.data, path)
+        self.mark_completed(path)
+        return True
+
+    def check_download(self, patch_path):
+        """Removes downloaded data and raises DownloadError if it doesn't match the hash"""
+        if self.hasher and self.hasher.is_complete():
+            valid = self.hasher.hexdigest() == self.data.hash.value
+        else:
+            valid = self.verify_downloaded_file(patch_path)
+        if not valid:
+            os.remove(patch_path)
+            raise DownloadError("checksum", "Checksum mismatch")
+
+    def fetch_cached(self, path) -> bool:
+        return self.blob_cache is not None and self.blob_cache.fetch(self.data, path)
+
+    def create_hasher(self, patch_path, ranges, written=None):
+        self.hasher = OrderedHasher(
+            get_hashing_function(self.data.hash.algorithm), patch_path, ranges, written
+        )
+        # Hash the data that is already there when resuming
+        self.hasher.catch_up()
+
+    def check_existing(self, path) -> bool:
+        """Checks if already installed file is valid"""
+        if not os.path.exists(path):
+            return False
+        if self.verify_cache and self.verify_cache.is_verified(self.data, path):
+            return True
+        return self.verify_downloaded_file(path)
+
+    def mark_completed(self, path):
+        if self.journal:
+            self.journal.mark_completed(self.data, path)
+        if self.verify_cache:
+            self.verify_cache.add(self.data, path)
+        if self.results:
+            self.results.file_completed(self.data)
+        self.copy_duplicates(path)
+
+    def copy_duplicates(self, path):
+        for duplicate in self.duplicates:
+            duplicate_path = duplicate.get_path()
+            if not (
+                duplicate.journal and duplicate.journal.is_completed(duplicate.data, duplicate_path)
+            ) and not duplicate.check_existing(duplicate_path):
+                clone_file(path, duplicate_path, hardlink=self.hardlink_duplicates)
+            self.progress.update_downloaded_size(duplicate.data.size)
+            duplicate.mark_completed(duplicate_path)
+
+    def slot(self):
+        """Context holding a transfer slot of the limiter"""
+        return self.limiter or nullcontext()
+
+    def request(self, headers):
+        started = time()
+        response = self.session.get(
+            self.download_url, stream=True, allow_redirects=True, headers=headers,
+            timeout=self.timeout
+        )
+        if self.limiter:
+            self.limiter.report_latency(time() - started)
+        if response.status_code >= 400:
+            response.close()
+            raise HTTPStatusError(response.status_code)
+        return response
+
+    def add_progress(self, amount, received=True):
+        """Reports data of the current attempt, received data also counts towards download speed"""
+        if received:
+            self.progress.update_download_speed(amount)
+        else:
+            self.progress.update_downloaded_size(amount)
+        with self.lock:
+            self.reported += amount
+
+    def reset_progress(self):
+        """Takes back progress reported by a failed attempt"""
+        with self.lock:
+            amount, self.reported = self.reported, 0
+        self.progress.update_downloaded_size(-amount)
+
+    def wait(self, delay):
+        if self.cancel_event:
+            self.cancel_event.wait(delay)
+        else:
+            sleep(delay)
+
+    def throttle(self, amount):
+        """Waits until received amount of bytes fits into the speed limit"""
+        if not self.bandwidth:
+            return
+        delay = self.bandwidth.reserve(amount)
+        if delay > 0:
+            self.wait(delay)
+
+    def get_chunk_size(self, total) -> int:
+        chunk_size = max(int(total / 1000), 1024 * 1024)
+        if self.bandwidth:
+            chunk_size = self.bandwidth.chunk_size(chunk_size)
+        return chunk_size
+
+    def is_cancelled(self) -> bool:
+        return self.cancel_event is not None and self.cancel_event.is_set()
 
     def verify_downloaded_file(self, path) -> bool:
         return self.data.hash.value == calculate_checksum(get_hashing_function(self.data.hash.algorithm), path)
 
-    def get_file(self, path):
-        if os.path.exists(path + ".patch"):
-            os.remove(path+".patch")
+    def get_resume_offset(self, path) -> int:
+        """Returns how many bytes of the partial download can be reused"""
+        if not self.journal or not os.path.exists(path):
+            return 0
+        offset = self.journal.get_progress(self.data).get(0, 0)
+        # Trust only the data that both journal and the disk agree on
+        return min(offset, os.path.getsize(path), self.data.size)
 
-        with open(path + ".patch", "ab") as f:
-            response = self.session.get(
-                self.download_url, stream=True, allow_redirects=True
-            )
-            total = response.headers.get("Content-Length")
-            if total is None:
-                self.progress.update_download_speed(len(response.content))
-                written = f.write(response.content)
-                self.progress.update_bytes_written(written)
-            else:
-                total = int(total)
-                for data in response.iter_content(
-                    chunk_size=max(int(total / 1000), 1024 * 1024)
-                ):
-                    self.progress.update_download_speed(len(data))
-                    written = f.write(data)
-                    self.progress.update_bytes_written(written)
+    def get_file(self, path) -> bool:
+        patch_path = path + ".patch"
+        offset = self.get_resume_offset(patch_path)
+        if offset and offset >= self.data.size:
+            # Whole file arrived before the last run stopped, the server would answer 416
+            self.add_progress(offset, received=False)
+            self.create_hasher(patch_path, [(0, self.data.size)], {0: offset})
+            if self.journal:
+                self.journal.clear_progress(self.data)
+            return True
+        headers = dict()
+        if offset:
+            headers["Range"] = f"bytes={offset}-"
+
+        with self.slot():
+            response = self.request(headers)
+            if offset and response.status_code != 206:
+                # Server ignored the range, start over
+                offset = 0
+            self.add_progress(offset, received=False)
+            self.create_hasher(patch_path, [(0, self.data.size)], {0: offset})
+
+            with self.open_patch(patch_path) as f:
+                f.seek(offset)
+                if not self.write_response(response, f, 0, offset):
+                    return False
+                f.truncate()
+
+        if self.journal:
+            self.journal.clear_progress(self.data)
+        return True
+
+    def open_patch(self, patch_path):
+        """Opens .patch file with space reserved for the whole file"""
+        f = open(patch_path, "r+b" if os.path.exists(patch_path) else "wb")
+        try:
+            preallocate(f, self.data.size)
+        except OSError:
             f.close()
+            raise
+        return f
 
-        shutil.move(path + ".patch", path)
-        """
-        if self.data.patch_hash:
-            patch_sum = calculate_checksum(
-                get_hashing_function(self.data.patch_hash_type), path + ".patch"
-            )
-            if self.data.patch_hash != patch_sum:
-                return self.get_file(path)
-            # Patch the file here
-            patcher = Patcher(
-                open(path, "rb"), open(path + ".patch", "rb"), open(path + ".new", "wb")
+    def get_segments(self):
+        """Splits the file into (start, end) ranges"""
+        return [
+            (start, min(start + self.segment_size, self.data.size))
+            for start in range(0, self.data.size, self.segment_size)
+        ]
+
+    def start_segments(self, path) -> bool:
+        patch_path = path + ".patch"
+        progress = dict()
+        if self.journal and os.path.exists(patch_path) and os.path.getsize(patch_path) == self.data.size:
+            progress = self.journal.get_progress(self.data)
+
+        self.open_patch(patch_path).close()
+
+        segments = self.get_segments()
+        self.segments_failed = False
+        self.segments_error = None
+        self.create_hasher(
+            patch_path,
+            segments,
+            {start: min(progress.get(start, 0), end - start) for start, end in segments},
+        )
+        self.segments_remaining = len(segments)
+        self.logger.debug(f"Downloading {self.data.path} in {len(segments)} segments")
+        for start, end in segments:
+            if self.is_cancelled():
+                return False
+            written = min(progress.get(start, 0), end - start)
+            self.submit(self.download_segment, path, start, end, written)
+        return True
+
+    def download_segment(self, path, start, end, written) -> bool:
+        success = False
+        error = None
+        try:
+            # Segments still queued when ranges turn out unsupported are skipped
+            success = not self.ranges_supported or self.get_range_with_retries(
+                path + ".patch", start, end, written
             )
+        except RangeNotSupported:
+            self.ranges_supported = False
+            success = True
+        except Exception as e:
+            error = e
+        finally:
+            with self.lock:
+                self.segments_remaining -= 1
+                self.segments_failed = self.segments_failed or not success
+                self.segments_error = self.segments_error or error
+                finished = self.segments_remaining == 0
+        if not finished:
+            # Outcome of the whole file is reported by the last segment
+            return True
+        # Last segment to finish completes the file
+        if not self.ranges_supported:
+            self.logger.debug(f"Server ignored ranges of {self.data.path}, downloading it in one piece")
+            if self.journal:
+                self.journal.clear_progress(self.data)
+            self.reset_progress()
+            return self.download(path)
+        if self.segments_error:
+            raise self.segments_error
+        if self.segments_failed:
+            return False
+        if self.journal:
+            self.journal.clear_progress(self.data)
+        try:
+            return self.finalize(path)
+        except Exception as e:
+            if self.is_cancelled() or not self.prepare_retry(e):
+                raise
+        return self.download(path)
 
-            patcher.run()
+    def get_range_with_retries(self, patch_path, start, end, written) -> bool:
+        self.add_progress(written, received=False)
+        attempt = 0
+        while True:
+            try:
+                return self.get_range(patch_path, start, end, written)
+            except RangeNotSupported:
+                raise
+            except Exception as e:
+                if self.is_cancelled():
+                    return False
+                delay = self.get_retry_delay(e, attempt)
+                if delay is None:
+                    raise
+                attempt += 1
+                self.wait(delay)
+                # Continue after the data that already reached the disk
+                written = self.hasher.get_written(start)
 
-            if (
-                calculate_checksum(
-                    get_hashing_function(self.data.target_hash_type), path + ".new"
-                )
-                == self.data.target_hash
-            ):
-                shutil.move(path + ".new", path)
-        else:
-        """
+    def get_range(self, patch_path, start, end, written) -> bool:
+        if start + written >= end:
+            return True
+
+        with self.slot():
+            response = self.request({"Range": f"bytes={start + written}-{end - 1}"})
+            if response.status_code != 206:
+                response.close()
+                raise RangeNotSupported()
+
+            with open(patch_path, "r+b") as f:
+                f.seek(start + written)
+                return self.write_response(response, f, start, written)
+
+    def write_response(self, response, f, start, written) -> bool:
+        """Streams response body to f, journaling progress of the range beginning at start"""
+        total = response.headers.get("Content-Length")
+        if total is None:
+            self.throttle(len(response.content))
+            self.add_progress(len(response.content))
+            bytes_written = f.write(response.content)
+            self.progress.update_bytes_written(bytes_written)
+            self.update_hash(f, start, response.content)
+            return True
+
+        for data in response.iter_content(chunk_size=self.get_chunk_size(int(total))):
+            if self.is_cancelled():
+                response.close()
+                return False
+            self.throttle(len(data))
+            self.add_progress(len(data))
+            if self.limiter:
+                self.limiter.report_bytes(len(data))
+            bytes_written = f.write(data)
+            self.progress.update_bytes_written(bytes_written)
+            self.update_hash(f, start, data)
+            written += bytes_written
+            if self.journal:
+                self.journal.set_progress(self.data, start, written)
+                self.journal.maybe_save()
+        return True
+
+    def update_hash(self, f, start, data):
+        if not self.hasher:
+            return
+        # Data has to reach the disk before other ranges may read it back
+        f.flush()
+        if self.hasher.update(start, data):
+            self.hasher.catch_up()
@@ -2,8 +2,9 @@ from nile.models.manifest import ManifestComparison
 
 class PatchBuilder():
     max_hashpairs_per_request = 1000
-    def __init__(self, manifest_comparison: ManifestComparison):
+    def __init__(self, manifest_comparison: ManifestComparison, include_new=True):
         self.mc = manifest_comparison
+        self.include_new = include_new
         self.hashpairs = []
 
     def build_hashpairs(self):
@@ -15,6 +16,8 @@ class PatchBuilder():
                                 algorithm=new_f.hash.algorithm.upper())
             ))
 
+        if not self.include_new:
+            return
         for f in self.mc.new:
             self.hashpairs.append(dict(
                 sourceHash=None,
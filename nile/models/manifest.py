@@ -99,7 +99,10 @@ class ManifestComparison:
     def __init__(self):
         self.new = []
         self.removed = []
+        # (old File, new File) pairs of files with changed content
         self.updated = []
+        # hash -> (old File, [new File, ...]) of new files which content is already installed
+        self.moved = dict()
 
     @classmethod
     def compare(cls, manifest, old_manifest=None):
@@ -116,14 +119,30 @@ class ManifestComparison:
                     continue
 
                 if f.hash.value != old_files[f.path].hash.value:
-                    comparison.new.append(f)
+                    comparison.updated.append((old_files[f.path], f))
                 # delete files that are in old_files and new manifest from this dict
                 del old_files[f.path]
 
             # all that remains are files that were removed!
             comparison.removed = old_files.values()
+            comparison.find_moved(old_manifest)
         else:
             # In this case there are just new files
             comparison.new = [f for f in manifest.packages[0].files]
 
         return comparison
+
+    def find_moved(self, old_manifest):
+        """Moves new files with content of some old file from new to moved"""
+        sources = {f.hash.value: f for f in old_manifest.packages[0].files}
+        # Prefer removed files, these can be renamed instead of copied
+        sources.update({f.hash.value: f for f in self.removed})
+
+        new = []
+        for f in self.new:
+            source = sources.get(f.hash.value)
+            if source is None or source.size != f.size:
+                new.append(f)
+                continue
+            self.moved.setdefault(f.hash.value, (source, []))[1].append(f)
+        self.new = new
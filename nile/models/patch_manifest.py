@@ -17,6 +17,7 @@ class PatchFile:
         urls,
         size,
         target_hash_type="sha256",
+        source_hash=None,
         patch_hash=None,
         patch_hash_type=None,
         patch_type=PatchType.NONE,
@@ -28,6 +29,7 @@ class PatchFile:
         self.patch_hash_type = patch_hash_type
         self.target_hash = target_hash
         self.target_hash_type = target_hash_type
+        self.source_hash = source_hash
         self.patch_type = patch_type
         self.patch_offset = patch_offset
         self.urls = urls
@@ -40,7 +42,8 @@ class PatchManifest:
         self.files = list()
 
     @classmethod
-    def build_patch_manifest(cls, comparison: ManifestComparison, patches_list: list):
+    def build_patch_manifest(cls, comparison: ManifestComparison, patches_list: list, include_new=True):
+        """Files without a matching patch in patches_list are left out"""
         patchmanifest = cls()
 
         patches = dict()
@@ -49,13 +52,15 @@ class PatchManifest:
 
         for old_file, new_file in comparison.updated:
             path, filename = os.path.split(new_file.path)
+            patch = patches.get(new_file.hash.value)
+            if not patch:
+                continue
             patchmanifest.dirs.add(path)
 
-            patch = patches[new_file.hash.value]
-
             patch_type = (
                 PatchType.NONE if patch["type"] == "NONE" else PatchType.FUEL_PATCH
             )
+            patch_hash = patch.get("patchHash") or dict()
 
             patchmanifest.files.append(
                 PatchFile(
@@ -65,17 +70,21 @@ class PatchManifest:
                     size=patch["size"],
                     target_hash=new_file.hash.value,
                     target_hash_type=new_file.hash.algorithm.lower(),
-                    patch_hash=patch["patchHash"]["value"],
-                    patch_hash_type=patch["patchHash"]["algorithm"].lower(),
+                    source_hash=old_file.hash.value,
+                    patch_hash=patch_hash.get("value"),
+                    patch_hash_type=patch_hash.get("algorithm", "").lower() or None,
                     patch_type=patch_type,
                 )
             )
 
+        if not include_new:
+            return patchmanifest
         for new_file in comparison.new:
             path, filename = os.path.split(new_file.path)
+            patch = patches.get(new_file.hash.value)
+            if not patch:
+                continue
             patchmanifest.dirs.add(path)
-
-            patch = patches[new_file.hash.value]
             patchmanifest.files.append(
                 PatchFile(
                     filename=filename,
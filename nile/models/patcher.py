@@ -1,12 +1,24 @@
 # FUEL_PATCH patcher
 # https://github.com/derrod/twl.py/blob/master/src/patching.py
+import io
+import os
+import errno
 import logging
+import collections
 import zstandard as zstd
 
 from enum import Enum
 
 logger = logging.getLogger('PATCHER')
 
+numpy_available = True
+
+try:
+    import numpy as np
+except Exception:
+    logger.debug('numpy unavailable, using pure Python merge')
+    numpy_available = False
+
 
 class Instructions(Enum):
     Seek = 0
@@ -20,18 +32,167 @@ class PatchCompression(Enum):
     ZSTD = 1  # zstandard
 
 
+# Indexed by the top two bits of an instruction byte
+INSTRUCTIONS = tuple(Instructions)
+# Instruction byte followed by up to 5 length bytes
+MAX_INSTRUCTION_SIZE = 6
+# Errors meaning the kernel can't copy between these files
+ZERO_COPY_UNSUPPORTED = {
+    errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP,
+    getattr(errno, "ENOTSUP", errno.EOPNOTSUPP), getattr(errno, "ENOTSOCK", errno.EINVAL),
+}
+
+
+def add_bytes(source, patch) -> bytes:
+    """Adds two equally long buffers byte by byte, modulo 256"""
+    if numpy_available:
+        return (np.frombuffer(source, np.uint8) + np.frombuffer(patch, np.uint8)).tobytes()
+    # SWAR on big integers: add the low 7 bits of every byte, then
+    # xor in the top bits, so carries never cross into the next byte
+    size = len(source)
+    high = int.from_bytes(b"\x80" * size, "little")
+    low = int.from_bytes(b"\x7f" * size, "little")
+    a = int.from_bytes(source, "little")
+    b = int.from_bytes(patch, "little")
+    return (((a & low) + (b & low)) ^ ((a ^ b) & high)).to_bytes(size, "little")
+
+
+class PatchReader:
+    """
+    Reads patch stream in big chunks into a reusable buffer
+    Instructions are parsed straight from the buffer, so the decompressor
+    isn't called for every byte. Patches that fit the buffer are decompressed
+    in one go, bigger ones are streamed through it
+    """
+
+    def __init__(self, stream, buffer_size=4*1024*1024):
+        self.stream = stream
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        # Unread data is buffer[position:end]
+        self.position = 0
+        self.end = 0
+        self.eof = False
+
+    def available(self) -> int:
+        return self.end - self.position
+
+    def fill(self, size):
+        """Buffers at least size bytes, unless the stream ends first"""
+        if self.available() >= size or self.eof:
+            return
+        remaining = self.available()
+        self.buffer[:remaining] = bytes(self.view[self.position:self.end])
+        self.position = 0
+        self.end = remaining
+        while self.end < size:
+            read = self.stream.readinto(self.view[self.end:])
+            if not read:
+                self.eof = True
+                break
+            self.end += read
+
+    def read(self, size):
+        """
+        Returns up to size bytes as a memoryview, empty at the end of the stream
+        The view is valid only until the next call
+        """
+        if self.position == self.end:
+            self.fill(len(self.buffer))
+        size = min(size, self.end - self.position)
+        data = self.view[self.position:self.position + size]
+        self.position += size
+        return data
+
+    def read_instruction(self):
+        """Returns (instruction, length), raises EOFError at the end of the patch"""
+        if self.end - self.position < MAX_INSTRUCTION_SIZE:
+            self.fill(len(self.buffer))
+            if self.position == self.end:
+                raise EOFError
+        buffer = self.buffer
+        position = self.position
+        byte = buffer[position]
+        position += 1
+
+        instruction = INSTRUCTIONS[byte >> 6]
+        if instruction == Instructions.Seek:
+            bitmask = 31
+            negative = byte & 32
+        else:
+            bitmask = 63
+            negative = False
+        length = byte & bitmask
+        if length >= bitmask - 4:
+            byte_count = length - (bitmask - 5)
+            if position + byte_count > self.end:
+                raise ValueError('Patch ends in the middle of an instruction')
+            length = int.from_bytes(buffer[position:position + byte_count], byteorder='big')
+            position += byte_count
+        self.position = position
+        length += 1
+        return instruction, -length if negative else length
+
+
+def read_exact(fp, size) -> bytes:
+    """Reads size bytes, stream readers may return less than asked for"""
+    data = fp.read(size)
+    if len(data) == size or not data:
+        return data
+    chunks = [data]
+    remaining = size - len(data)
+    while remaining:
+        chunk = fp.read(remaining)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b"".join(chunks)
+
+
+def read_instructions(patch_fp):
+    """Yields (instruction, length) of every instruction in a patch, skipping over its data"""
+    compression = PatchCompression(int.from_bytes(patch_fp.read(1), byteorder='big'))
+    if compression == PatchCompression.ZSTD:
+        stream = zstd.ZstdDecompressor().stream_reader(patch_fp)
+    else:
+        stream = patch_fp
+    reader = PatchReader(stream)
+    while True:
+        try:
+            instruction, length = reader.read_instruction()
+        except EOFError:
+            return
+        yield instruction, length
+        if instruction in (Instructions.Insert, Instructions.Merge):
+            while length > 0:
+                data = reader.read(length)
+                if not data:
+                    raise ValueError('Patch ends in the middle of instruction data')
+                length -= len(data)
+
+
 class Patcher:
     """
     Patcher to apply FUEL_PATCH patches
     Written based on reference in Twitch App, so not perfectly pythonic
     """
 
-    def __init__(self, source_fp, patch_fp, target_fp, block_size=1024*1024):
+    # Shorter Copy instructions aren't worth flushing the target for
+    zero_copy_threshold = 256 * 1024
+
+    def __init__(self, source_fp, patch_fp, target_fp, block_size=1024*1024, progress=None):
         self._source = source_fp
         self._patch = patch_fp
         self._patch_raw = None
         self._target = target_fp
         self.block_size = block_size  # work on data in 1 MiB blocks
+        # Optional callable receiving number of bytes written to target
+        self.progress = progress
+        # Kernel copy methods to try, dropped once they turn out unsupported
+        self.zero_copy_methods = [
+            method for method in ("copy_file_range", "sendfile") if hasattr(os, method)
+        ]
 
     def run(self):
         patch_compression = PatchCompression(int.from_bytes(self._patch.read(1), byteorder='big'))
@@ -54,9 +215,10 @@ class Patcher:
         self._target.close()
 
     def apply_patches(self):
+        self._reader = PatchReader(self._patch)
         while True:
             try:
-                instruction, length = self.read_instruction()
+                instruction, length = self._reader.read_instruction()
                 self.apply_instruction(instruction, length)
             except EOFError:
                 break
@@ -64,63 +226,222 @@ class Patcher:
                 print(repr(e))
                 break
 
-    def read_instruction(self):
-        next_byte = self._patch.read(1)
-        if not next_byte:
-            raise EOFError
-
-        patch_start_byte = int.from_bytes(next_byte, byteorder='big')
-        instruction = Instructions(patch_start_byte >> 6)
-        bit_count = 5 if instruction == Instructions.Seek else 6
-        length = self.get_length(patch_start_byte, bit_count)
-        if instruction == instruction.Seek and patch_start_byte & 32:
-            length *= -1
-        return instruction, length
-
-    def get_length(self, encoded_length, bit_count):
-        bitmask = 2**bit_count - 1
-        length = encoded_length & bitmask
-        if length < (bitmask - 4):
-            return length + 1
-        else:
-            byte_count = length - (bitmask - 5)
-            length = int.from_bytes(self._patch.read(byte_count), byteorder='big')
-            return length + 1
-
     def apply_instruction(self, instruction, length):
         if instruction == Instructions.Seek:
             # logger.debug(f'Seek {length}')
-            self._source.seek(length, 1)
+            self.seek(length)
         elif instruction == Instructions.Copy:
             # logger.debug(f'Copy {length}')
-            self.copy(self._source, self._target, length)
+            copied = self.copy_range(length)
+            self.copy(length - copied)
         elif instruction == Instructions.Insert:
             # logger.debug(f'Insert {length}')
-            self.copy(self._patch, self._target, length)
+            self.insert(length)
         elif instruction == Instructions.Merge:
             # logger.debug(f'Merge {length}')
             self.merge(length)
+        if self.progress and instruction != Instructions.Seek:
+            self.progress(length)
 
-    def copy(self, source, target, length):
+    def seek(self, offset):
+        self._source.seek(offset, 1)
+
+    def read_source(self, size) -> bytes:
+        return read_exact(self._source, size)
+
+    def write(self, data):
+        self._target.write(data)
+
+    def copy(self, length):
         while length > 0:
-            target.write(source.read(min(self.block_size, length)))
-            length -= self.block_size
+            data = self.read_source(min(self.block_size, length))
+            if not data:
+                raise ValueError('Copy length is longer than input')
+            self.write(data)
+            length -= len(data)
 
-    def merge(self, length):
+    def copy_range(self, length) -> int:
+        """
+        Copies data from source to target without passing it through Python
+        copy_file_range can also reflink on Btrfs/XFS. Returns number of bytes copied
+        """
+        if length < self.zero_copy_threshold or not self.zero_copy_methods:
+            return 0
+        try:
+            source_fd = self._source.fileno()
+            target_fd = self._target.fileno()
+        except (AttributeError, io.UnsupportedOperation):
+            self.zero_copy_methods = []
+            return 0
+
+        self._target.flush()
+        source_offset = self._source.tell()
+        target_offset = self._target.tell()
+        copied = 0
+        while copied < length and self.zero_copy_methods:
+            method = self.zero_copy_methods[0]
+            try:
+                done = self.kernel_copy(
+                    method, source_fd, target_fd, length - copied,
+                    source_offset + copied, target_offset + copied
+                )
+            except OSError as e:
+                if e.errno not in ZERO_COPY_UNSUPPORTED:
+                    raise
+                logger.debug(f'{method} unsupported: {e!r}')
+                self.zero_copy_methods.pop(0)
+                continue
+            if not done:
+                raise ValueError('Copy length is longer than input')
+            copied += done
+        # Kernel copies don't move buffered file positions
+        self._source.seek(source_offset + copied)
+        self._target.seek(target_offset + copied)
+        return copied
+
+    @staticmethod
+    def kernel_copy(method, source_fd, target_fd, count, source_offset, target_offset) -> int:
+        if method == "copy_file_range":
+            return os.copy_file_range(source_fd, target_fd, count, source_offset, target_offset)
+        # sendfile writes at the current position of target
+        os.lseek(target_fd, target_offset, os.SEEK_SET)
+        return os.sendfile(target_fd, source_fd, source_offset, count)
+
+    def insert(self, length):
         while length > 0:
-            source_buffer = self._source.read(min(self.block_size, length))
-            if not source_buffer:
-                raise ValueError('Merge length is longer than source')
+            data = self._reader.read(min(self.block_size, length))
+            if not data:
+                raise ValueError('Insert length is longer than patch')
+            self.write(data)
+            length -= len(data)
 
-            patch_buffer = self._patch.read(min(self.block_size, length))
+    def merge(self, length):
+        while length > 0:
+            patch_buffer = self._reader.read(min(self.block_size, length))
             if not patch_buffer:
                 raise ValueError('Merge length is longer than patch')
 
+            source_buffer = self.read_source(len(patch_buffer))
+            if not source_buffer:
+                raise ValueError('Merge length is longer than source')
+
             if len(patch_buffer) != len(source_buffer):
                 raise ValueError('Patch and Source do not have same length!')
 
-            for s, p in zip(source_buffer, patch_buffer):
-                result = (s + p) % 2**8
-                self._target.write(result.to_bytes(1, byteorder='big'))
+            self.write(add_bytes(source_buffer, patch_buffer))
+            length -= len(patch_buffer)
+
+class InPlacePatcher(Patcher):
+    """
+    Applies patch over the source file itself, so huge files don't need free space for a copy
+    Source may be read at most overlap_size bytes behind the write position,
+    original data overwritten within that window is kept in memory.
+    Check the patch with is_safe() first, a file patched halfway is neither old nor new
+    """
+
+    overlap_size = 16 * 1024 * 1024
+
+    def __init__(self, file_fp, patch_fp, block_size=1024*1024, progress=None):
+        super().__init__(file_fp, patch_fp, file_fp, block_size, progress)
+        # Reads and writes share one file position, both are tracked here
+        self.read_position = 0
+        self.write_position = 0
+        self.source_size = file_fp.seek(0, os.SEEK_END)
+        # (offset, original data) of ranges overwritten within the overlap window
+        self.overlap = collections.deque()
+        # Kernel can't copy overlapping ranges of the same file
+        self.zero_copy_methods = []
+
+    @classmethod
+    def is_safe(cls, patch_fp, source_size) -> bool:
+        """Checks that patch never reads source data already lost to the write position"""
+        read_position = write_position = 0
+        for instruction, length in read_instructions(patch_fp):
+            if instruction == Instructions.Seek:
+                read_position += length
+            elif instruction == Instructions.Insert:
+                write_position += length
+            else:
+                if (
+                    write_position - read_position > cls.overlap_size
+                    or read_position < 0
+                    or read_position + length > source_size
+                ):
+                    return False
+                read_position += length
+                write_position += length
+        return True
+
+    def apply_patches(self):
+        super().apply_patches()
+        self._target.truncate(self.write_position)
+
+    def seek(self, offset):
+        self.read_position += offset
+
+    def copy(self, length):
+        if self.read_position != self.write_position:
+            return super().copy(length)
+        # Unchanged data is already in place
+        if self.read_position + length > self.source_size:
+            raise ValueError('Copy length is longer than input')
+        self.read_position += length
+        self.write_position += length
+        self.trim_overlap()
+
+    def read_source(self, size) -> bytes:
+        start = self.read_position
+        end = min(start + size, self.source_size)
+        if start < 0:
+            raise ValueError('Seek before the start of input')
+        parts = []
+        if start < self.write_position:
+            split = min(end, self.write_position)
+            parts.append(self.read_overwritten(start, split))
+            start = split
+        if start < end:
+            parts.append(self.read_file(start, end))
+        data = b"".join(parts)
+        self.read_position += len(data)
+        return data
+
+    def read_overwritten(self, start, end) -> bytes:
+        """Returns original data of a range behind the write position"""
+        if start < self.write_position - self.overlap_size:
+            raise ValueError('Patch reads data overwritten outside of the overlap buffer')
+        parts = []
+        position = start
+        for offset, data in self.overlap:
+            if offset + len(data) <= position:
+                continue
+            if offset >= end:
+                break
+            if offset > position:
+                # Skipped by unchanged Copy, so still original on disk
+                parts.append(self.read_file(position, offset))
+                position = offset
+            stop = min(end, offset + len(data))
+            parts.append(data[position - offset:stop - offset])
+            position = stop
+        if position < end:
+            parts.append(self.read_file(position, end))
+        return b"".join(parts)
+
+    def read_file(self, start, end) -> bytes:
+        self._source.seek(start)
+        return read_exact(self._source, end - start)
+
+    def write(self, data):
+        start = self.write_position
+        end = min(start + len(data), self.source_size)
+        if start < end:
+            self.overlap.append((start, self.read_file(start, end)))
+        self._target.seek(start)
+        self._target.write(data)
+        self.write_position += len(data)
+        self.trim_overlap()
 
-            length -= self.block_size
\ No newline at end of file
+    def trim_overlap(self):
+        limit = self.write_position - self.overlap_size
+        while self.overlap and self.overlap[0][0] + len(self.overlap[0][1]) <= limit:
+            self.overlap.popleft()
@@ -1,6 +1,9 @@
 import os
+import math
+import errno
 import shutil
 import hashlib
+import threading
 from nile.constants import ILLEGAL_FNAME_CHARS
 
 
@@ -14,6 +17,30 @@ def get_readable_size(size):
     return size, power_labels[n] + "B"
 
 
+SPEED_UNITS = {"": 1, "K": 2**10, "M": 2**20, "G": 2**30}
+
+
+def parse_speed(value) -> int:
+    """
+    Parses speed like 500K, 2.5M or 1GiB/s into bytes per second
+    0 means unlimited, raises ValueError for invalid input
+    """
+    if isinstance(value, (int, float)):
+        speed = value
+    else:
+        text = str(value).strip().upper()
+        for suffix in ("/S", "B", "I"):
+            if text.endswith(suffix):
+                text = text[: -len(suffix)]
+        unit = text[-1:] if text[-1:] in SPEED_UNITS else ""
+        speed = float(text[: len(text) - len(unit)]) * SPEED_UNITS[unit]
+    if not math.isfinite(speed):
+        raise ValueError("speed has to be a finite number")
+    if speed < 0:
+        raise ValueError("speed can't be negative")
+    return int(speed)
+
+
 def save_directory_name(title: str) -> str:
     output = title
     for char in ILLEGAL_FNAME_CHARS:
@@ -30,6 +57,61 @@ def check_available_space(size, path) -> bool:
     return size < available
 
 
+# Errors meaning the allocation can't be satisfied
+NO_SPACE_ERRORS = (errno.ENOSPC, getattr(errno, "EDQUOT", errno.ENOSPC))
+
+
+def preallocate(f, size):
+    """
+    Reserves size bytes for the file, falls back to sparse file where unsupported
+    Raises OSError with ENOSPC if there is not enough space
+    """
+    if size:
+        try:
+            os.posix_fallocate(f.fileno(), 0, size)
+        except AttributeError:
+            pass
+        except OSError as e:
+            if e.errno in NO_SPACE_ERRORS:
+                raise
+    f.truncate(size)
+
+
+# ioctl request for cloning a file, see ioctl_ficlone(2)
+FICLONE = 0x40049409
+
+
+def reflink(source, target) -> bool:
+    """Makes target share data blocks with source (Btrfs, XFS), returns False if unsupported"""
+    try:
+        import fcntl
+    except ImportError:
+        return False
+    with open(source, "rb") as src, open(target, "wb") as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except OSError:
+            return False
+    return True
+
+
+def clone_file(source, target, hardlink=False):
+    """Creates target with the same content as source using the cheapest available method"""
+    temp_path = target + ".patch"
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+    linked = False
+    if hardlink:
+        try:
+            os.link(source, temp_path)
+            linked = True
+        except OSError:
+            pass
+    if not linked and not reflink(source, temp_path):
+        shutil.copyfile(source, temp_path)
+    os.replace(temp_path, target)
+
+
 def calculate_checksum(hashing_function, path):
     with open(path, 'rb') as f:
         calculate = hashing_function()
@@ -41,6 +123,92 @@ def calculate_checksum(hashing_function, path):
 
         return calculate.hexdigest()
 
+class OrderedHasher:
+    """
+    Hashes a file while it's being written by one or more ranges
+    Data written at the hash cursor is hashed right away, data written ahead
+    of the cursor is read back from the disk once the cursor gets there
+    """
+
+    read_size = 1024 * 1024
+
+    def __init__(self, hashing_function, path, ranges, written=None):
+        self.hash = hashing_function()
+        self.path = path
+        # Sorted, contiguous list of (start, end)
+        self.ranges = ranges
+        self.written = {start: (written or dict()).get(start, 0) for start, _ in ranges}
+        self.size = ranges[-1][1] if ranges else 0
+        self.index = 0
+        self.cursor = 0
+        self.catching_up = False
+        self.lock = threading.Lock()
+
+    def update(self, start, data) -> bool:
+        """
+        Call after data was written to the disk at the end of the range beginning at start
+        Returns True if catch_up has to be called
+        """
+        with self.lock:
+            if not self.catching_up and start + self.written[start] == self.cursor:
+                self.hash.update(data)
+                self.cursor += len(data)
+            self.written[start] += len(data)
+            return self._pending()
+
+    def _pending(self) -> bool:
+        # Needs to be called with lock held
+        if self.catching_up:
+            return False
+        while self.index < len(self.ranges):
+            start, end = self.ranges[self.index]
+            if self.cursor < start + self.written[start]:
+                return True
+            if self.cursor < end:
+                return False
+            self.index += 1
+        return False
+
+    def catch_up(self):
+        """Hashes data that was written to the disk ahead of the cursor"""
+        with self.lock:
+            if not self._pending():
+                return
+            self.catching_up = True
+        with open(self.path, "rb") as f:
+            while True:
+                with self.lock:
+                    self.catching_up = False
+                    if not self._pending():
+                        return
+                    self.catching_up = True
+                    start, _ = self.ranges[self.index]
+                    position = self.cursor
+                    available = start + self.written[start]
+                f.seek(position)
+                chunk = f.read(min(self.read_size, available - position))
+                if not chunk:
+                    with self.lock:
+                        self.catching_up = False
+                    return
+                # Only the catching up thread touches the hash at this point
+                self.hash.update(chunk)
+                with self.lock:
+                    self.cursor += len(chunk)
+
+    def get_written(self, start) -> int:
+        """Returns how much of the range beginning at start was written"""
+        with self.lock:
+            return self.written[start]
+
+    def is_complete(self) -> bool:
+        with self.lock:
+            return not self.catching_up and self.cursor == self.size
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+
 def get_hashing_function(h_type):
     if h_type.lower() == "sha256":
         return hashlib.sha256
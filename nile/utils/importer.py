@@ -4,17 +4,19 @@ import urllib.parse
 from nile.models import manifest
 from nile.downloading.worker import DownloadWorker
 from nile.utils.config import ConfigType
+from nile.utils.verify_cache import VerificationCache
 from multiprocessing import cpu_count
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
 class Importer:
-    def __init__(self, game, folder_path, config, library_manager, session_manager, download_manager):
+    def __init__(self, game, folder_path, config, library_manager, session_manager, download_manager, full_verify=False):
         self.game = game
         self.folder_path = folder_path
         self.config = config
         self.library_manager = library_manager
         self.session_manager = session_manager
         self.download_manager = download_manager
+        self.verify_cache = VerificationCache(config, game["product"]["id"], full=full_verify)
         self.logger = logging.getLogger("IMPORT")
 
         self.threads = []
@@ -49,15 +51,23 @@ class Importer:
                 file,
                 local_path,
                 self.session_manager,
-                None
+                None,
+                verify_cache=self.verify_cache
             )
-            self.threads.append(self.thpool.submit(worker.verify_downloaded_file, local_path))
+            self.threads.append(self.thpool.submit(self.verify_file, worker, local_path))
 
         for thread in as_completed(self.threads):
             if thread.cancelled() or not thread.result():
                 self.stop_threads()
                 return False
 
+        self.verify_cache.save()
+        return True
+
+    def verify_file(self, worker, local_path):
+        if not worker.check_existing(local_path):
+            return False
+        self.verify_cache.add(worker.data, local_path)
         return True
 
     def import_game(self):
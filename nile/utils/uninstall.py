@@ -48,6 +48,7 @@ class Uninstaller:
 
         self.config.write("installed", installed_games)
         self.config.remove(f"manifests/{game_id}", cfg_type=ConfigType.RAW)
+        self.config.remove(f"verified/{game_id}")
         self.logger.info("Game removed successfully")
 
     def load_installed_manifest(self, game_id):
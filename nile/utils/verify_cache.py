@@ -0,0 +1,51 @@
+import os
+import threading
+from nile.models.manifest import File
+
+
+class VerificationCache:
+    """
+    Remembers installed files that passed verification, keyed by their stat data
+    Files that didn't change since then don't need to be hashed again
+    """
+
+    def __init__(self, config_manager, game_id, full=False):
+        self.config = config_manager
+        self.store = f"verified/{game_id}"
+        self.lock = threading.Lock()
+        self.changed = False
+        # manifest path -> [size, mtime, inode, hash]
+        self.entries = dict()
+        # With full verification every file gets hashed, results are still saved
+        if not full:
+            self.entries = self.config.get(self.store) or dict()
+
+    @staticmethod
+    def get_key(file: File, path):
+        stat = os.stat(path)
+        return [stat.st_size, stat.st_mtime_ns, stat.st_ino, file.hash.value]
+
+    def is_verified(self, file: File, path) -> bool:
+        entry = self.entries.get(file.path)
+        if not entry:
+            return False
+        try:
+            return entry == self.get_key(file, path)
+        except OSError:
+            return False
+
+    def add(self, file: File, path):
+        key = self.get_key(file, path)
+        with self.lock:
+            self.entries[file.path] = key
+            self.changed = True
+
+    def save(self):
+        with self.lock:
+            if not self.changed:
+                return
+            self.config.write(self.store, dict(self.entries))
+            self.changed = False
+
+    def remove(self):
+        self.config.remove(self.store)